@@ -3,6 +3,7 @@
 import asyncio
 import json
 import re
+import threading
 from channel.http import auth
 from channel.http import rest
 from flask import Flask, Response, request, render_template, make_response, stream_with_context
@@ -17,8 +18,13 @@ from common import log
 from plugins.plugin_manager import *
 from model import model_factory
 
+# server: "flask" (development server) or "gunicorn"; async_mode: threading, eventlet or gevent (auto-detected if unset)
+http_server = channel_conf_val(const.HTTP, 'server', 'flask')
+
 http_app = Flask(__name__,)
-socketio = SocketIO(http_app, path='/sfbot/socket.io', cors_allowed_origins=['https://api.sflow.io'], close_timeout=5)
+# with several workers, emits are relayed through the message queue (e.g: redis://127.0.0.1:6379/0)
+socketio = SocketIO(http_app, path='/sfbot/socket.io', cors_allowed_origins=['https://api.sflow.io'], close_timeout=5,
+                    async_mode=channel_conf_val(const.HTTP, 'async_mode'), message_queue=channel_conf_val(const.HTTP, 'message_queue'))
 CORS(http_app) # supports_credentials=True
 
 @http_app.after_request
@@ -33,55 +39,215 @@ def is_valid_uuid(uuidstr):
     pattern = r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
     return bool(re.match(pattern, uuidstr, re.IGNORECASE))
 
-# 自动重载模板文件
-http_app.jinja_env.auto_reload = True
-http_app.config['TEMPLATES_AUTO_RELOAD'] = True
+# 自动重载模板文件 (development server only)
+if http_server == 'flask':
+    http_app.jinja_env.auto_reload = True
+    http_app.config['TEMPLATES_AUTO_RELOAD'] = True
 
 # 设置静态文件缓存过期时间
 http_app.config['SEND_FILE_MAX_AGE_DEFAULT'] = timedelta(seconds=1)
 
+stream_loop = None
+stream_loop_lock = threading.Lock()
+
+def get_stream_loop():
+    """
+    one long-lived event loop per process, shared by all streaming requests
+    """
+    global stream_loop
+    with stream_loop_lock:
+        if stream_loop is None:
+            stream_loop = asyncio.new_event_loop()
+            threading.Thread(target=stream_loop.run_forever, name='stream-loop', daemon=True).start()
+    return stream_loop
+
+def stream_done(future):
+    if future.exception() is not None:
+        log.warn("[http]stream:{}", future.exception())
+
+def split_extra(response):
+    extra={}
+    splits=response.split("```sf-json")
+    if len(splits)==2:
+        extra=json.loads(splits[1][1:-4])
+        response=splits[0]
+    return response, extra
+
+def full_frame(response, extra, final):
+    return {
+        'result': response,
+        'docs': extra.get('docs',[]),
+        'pages': extra.get('pages',[]),
+        'resources': extra.get('resources',[]),
+        'commands': extra.get('commands',[]),
+        'teammode': extra.get('teammode',None),
+        'teamid': extra.get('teamid',None),
+        'teambotid': extra.get('teambotid',None),
+        'logid': extra.get('logid',None),
+        'final': final,
+    }
+
+class DeltaFrames(object):
+    """
+    stream_mode "delta": partial frames carry only the text added since the previous frame,
+    {'delta', 'seq', 'final': False}; the final frame adds the metadata and the total 'length'.
+    if the reply is ever rewritten rather than extended, a {'result', 'reset': True} frame
+    replaces the client's text.
+    """
+    def __init__(self):
+        self.sent = ''
+        self.seq = 0
+
+    def frame(self, response, extra, final):
+        """
+        :return: the frame to emit, None when a partial adds no text
+        """
+        if not final and response == self.sent:
+            return None
+        if response.startswith(self.sent):
+            frame = {'delta': response[len(self.sent):]}
+        else:
+            frame = {'result': response, 'reset': True}
+        self.sent = response
+        frame['seq'] = self.seq
+        self.seq += 1
+        frame['final'] = final
+        if final:
+            frame.update({k: v for k, v in full_frame(response, extra, final).items() if k != 'result'})
+            frame['length'] = len(response)
+        return frame
+
+class StreamEmitter(object):
+    """
+    coalesces partial replies into socket.io frames: text is flushed every stream_flush_ms,
+    or at once when stream_flush_bytes of new utf-8 text are waiting. while the client's outgoing
+    packet queue stays above stream_backpressure_frames the interval doubles up to
+    stream_max_flush_ms, the size trigger grows by the same factor, and both relax again
+    once the client catches up.
+    """
+    def __init__(self, sid, frames=None):
+        self.sid = sid
+        self.frames = frames
+        self.base_ms = float(channel_conf_val(const.HTTP, 'stream_flush_ms', 50))
+        self.max_ms = float(channel_conf_val(const.HTTP, 'stream_max_flush_ms', 1000))
+        self.flush_bytes = int(channel_conf_val(const.HTTP, 'stream_flush_bytes', 512))
+        self.backpressure = int(channel_conf_val(const.HTTP, 'stream_backpressure_frames', 16))
+        self.interval_ms = self.base_ms
+        self.latest = None
+        self.sent = None
+        self.sent_len = 0
+        self.seen = ''
+        self.pending_bytes = 0
+        self.closed = False
+        self.counters = {'chunks': 0, 'frames': 0, 'bytes': 0, 'slowdowns': 0}
+
+    def update(self, response):
+        self.counters['chunks'] += 1
+        self.latest = response
+        # partial replies normally extend the previous one, only encode what was added
+        if len(response) >= len(self.seen) and response.startswith(self.seen):
+            self.pending_bytes += len(response[len(self.seen):].encode('utf-8'))
+        else:
+            self.pending_bytes += len(response.encode('utf-8'))
+        self.seen = response
+        if self.pending_bytes >= self.flush_bytes * self.interval_ms / self.base_ms:
+            self.flush()
+
+    async def flush_loop(self):
+        while not self.closed:
+            await asyncio.sleep(self.interval_ms / 1000.0)
+            self.adjust()
+            self.flush()
+
+    def adjust(self):
+        depth = self.queue_depth()
+        if depth > self.backpressure:
+            if self.interval_ms < self.max_ms:
+                self.interval_ms = min(self.interval_ms * 2, self.max_ms)
+                self.counters['slowdowns'] += 1
+                log.info("[http]stream {} backpressure depth={} interval={}ms", self.sid, depth, self.interval_ms)
+        elif depth == 0 and self.interval_ms > self.base_ms:
+            self.interval_ms = max(self.interval_ms / 2, self.base_ms)
+
+    def queue_depth(self):
+        # packets engine.io has not written to the client yet
+        try:
+            eio_sid = socketio.server.manager.eio_sid_from_sid(self.sid, "/sfbot/chat")
+            return socketio.server.eio.sockets[eio_sid].queue.qsize()
+        except Exception:
+            return 0
 
-async def return_stream(data):
-    async for final, response in HttpChannel().handle_stream(data=data):
+    def flush(self):
+        if self.closed or self.latest is None:
+            return
+        response = self.latest
+        self.latest = None
+        self.pending_bytes = 0
+        if self.frames is not None:
+            frame = self.frames.frame(response, {}, False)
+            if frame is None:
+                return
+            payload = frame.get('delta', frame.get('result'))
+        else:
+            if len(response) == self.sent_len and response == self.sent:
+                return
+            frame = full_frame(response, {}, False)
+            payload = response
+            self.sent = response
+        self.sent_len = len(response)
+        self.emit('message', frame, payload)
+
+    def finish(self, response, extra):
+        self.latest = None
+        if self.frames is not None:
+            frame = self.frames.frame(response, extra, True)
+            payload = frame.get('delta', frame.get('result'))
+        else:
+            frame = full_frame(response, extra, True)
+            payload = response
+        self.emit('disconnect', frame, payload)
+        self.close()
+
+    def emit(self, event, frame, payload):
         try:
-            extra={}
-            splits=response.split("```sf-json")
-            if len(splits)==2:
-                extra=json.loads(splits[1][1:-4])
-                response=splits[0]
-            if (final):
-                socketio.server.emit(
-                    'disconnect', {
-                        'result': response,
-                        'docs': extra.get('docs',[]),
-                        'pages': extra.get('pages',[]),
-                        'resources': extra.get('resources',[]),
-                        'commands': extra.get('commands',[]),
-                        'teammode': extra.get('teammode',None),
-                        'teamid': extra.get('teamid',None),
-                        'teambotid': extra.get('teambotid',None),
-                        'logid': extra.get('logid',None),
-                        'final': final,
-                    }, request.sid, namespace="/sfbot/chat")
-                disconnect()
-            else:
-                socketio.server.emit(
-                    'message', {
-                        'result': response,
-                        'docs': extra.get('docs',[]),
-                        'pages': extra.get('pages',[]),
-                        'resources': extra.get('resources',[]),
-                        'commands': extra.get('commands',[]),
-                        'teammode': extra.get('teammode',None),
-                        'teamid': extra.get('teamid',None),
-                        'teambotid': extra.get('teambotid',None),
-                        'logid': extra.get('logid',None),
-                        'final': final,
-                    }, request.sid, namespace="/sfbot/chat")
+            socketio.server.emit(event, frame, self.sid, namespace="/sfbot/chat")
+            self.counters['frames'] += 1
+            self.counters['bytes'] += len(payload.encode('utf-8'))
         except Exception as e:
-            disconnect()
             log.warn("[http]emit:{}", e)
-            break
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            socketio.server.disconnect(self.sid, namespace="/sfbot/chat")
+            log.info("[http]stream {} {}", self.sid, self.counters)
+
+async def return_stream(data, sid):
+    frames = None
+    if data.get('stream_mode') == 'delta':
+        frames = DeltaFrames()
+    emitter = StreamEmitter(sid, frames)
+    flusher = asyncio.get_running_loop().create_task(emitter.flush_loop())
+    stream = HttpChannel().handle_stream(data=data)
+    try:
+        async for final, response in stream:
+            if emitter.closed:
+                break
+            try:
+                if (final):
+                    response, extra = split_extra(response)
+                    emitter.finish(response, extra)
+                    break
+                emitter.update(response)
+            except Exception as e:
+                log.warn("[http]emit:{}", e)
+                break
+    finally:
+        flusher.cancel()
+        emitter.flush()
+        emitter.close()
+        await stream.aclose()
 
 
 @socketio.on('message', namespace='/sfbot/chat')
@@ -102,13 +268,14 @@ def stream(data):
                 'disconnect', {'result': reply_text}, namespace='/sfbot/chat')
             disconnect()
             return
-        asyncio.run(return_stream(data))
+        future = asyncio.run_coroutine_threadsafe(return_stream(data, request.sid), get_stream_loop())
+        future.add_done_callback(stream_done)
 
 
 @socketio.on('connect', namespace='/sfbot/chat')
 def connect():
     log.info('connected')
-    socketio.emit('message', {'info': "connected"}, namespace='/sfbot/chat')
+    socketio.emit('message', {'info': "connected", 'stream_modes': ['full', 'delta']}, namespace='/sfbot/chat')
 
 
 @socketio.on('disconnect', namespace='/sfbot/chat')
@@ -270,7 +437,12 @@ def filesearch():
 
 class HttpChannel(Channel):
     def startup(self):
-        http_app.run(host='0.0.0.0', port=channel_conf(const.HTTP).get('port'))
+        port = channel_conf(const.HTTP).get('port')
+        if http_server == 'gunicorn':
+            from channel.http import server
+            server.run(http_app, port, socketio.async_mode, channel_conf(const.HTTP))
+        else:
+            http_app.run(host='0.0.0.0', port=port)
 
     def handle(self, data):
         context = dict()
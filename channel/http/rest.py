@@ -10,7 +10,7 @@ from common import const
 from common.redis import RedisSingleton
 from config import model_conf, common_conf_val
 from common import log
-from langchain_openai import OpenAIEmbeddings
+from common.embedding_cache import cached_embeddings
 
 def calculate_md5(string):
     md5_hash = hashlib.md5()
@@ -60,7 +60,7 @@ def filesearch(request):
 
         oai_key = model_conf(const.OPEN_AI).get('api_key')
         oai_embeddings_model = "text-embedding-ada-002"
-        oai_embeddings = OpenAIEmbeddings(openai_api_key=oai_key, model=oai_embeddings_model)
+        oai_embeddings = cached_embeddings(oai_key, oai_embeddings_model)
         myquery = oai_embeddings.embed_query(query)
 
         offset = data.get("offset", 0)
@@ -77,11 +77,12 @@ def filesearch(request):
             return True, []
 
         results = []
+        pagerows = myredis.hydrate(pages, ['filename', 'source', 'page', 'text'])
         for i, page in enumerate(pages):
-            filename = myredis.redis.hget(page.id, 'filename')
-            pageurl = myredis.redis.hget(page.id, 'source')
-            pagenum = myredis.redis.hget(page.id, 'page')
-            pagetext = myredis.redis.hget(page.id, 'text')
+            filename = pagerows[i]['filename']
+            pageurl = pagerows[i]['source']
+            pagenum = pagerows[i]['page']
+            pagetext = pagerows[i]['text']
             vscore = 1.0 - float(page.vector_score)
             if vscore < 0.75:
                 break
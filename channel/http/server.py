@@ -0,0 +1,63 @@
+# encoding:utf-8
+
+"""
+production serving of the http channel with gunicorn
+"""
+
+import multiprocessing
+from gunicorn.app.base import BaseApplication
+from common import log
+
+# worker class per flask_socketio async_mode
+WORKER_CLASSES = {
+    'threading': 'gthread',
+    'eventlet': 'eventlet',
+    'gevent': 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker',
+}
+
+class GunicornServer(BaseApplication):
+    """
+    gunicorn master embedded in app.py: SIGHUP reloads workers gracefully,
+    SIGTERM drains in-flight requests within graceful_timeout
+    """
+    def __init__(self, app, options):
+        self.application = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None and key in self.cfg.settings:
+                self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def worker_count(workers):
+    workers = int(workers or 1)
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+    return workers
+
+def run(app, port, async_mode, conf):
+    """
+    :param conf: http channel config, reads workers/threads/worker_connections/graceful_timeout/timeout/pidfile
+    """
+    workers = worker_count(conf.get('workers', 1))
+    options = {
+        'bind': '0.0.0.0:{}'.format(port),
+        'workers': workers,
+        'worker_class': WORKER_CLASSES.get(async_mode, 'gthread'),
+        'threads': int(conf.get('threads', 100)),
+        'worker_connections': int(conf.get('worker_connections', 1000)),
+        'graceful_timeout': int(conf.get('graceful_timeout', 30)),
+        # streamed answers keep a request open far longer than the 30s default
+        'timeout': int(conf.get('timeout', 300)),
+        'keepalive': int(conf.get('keepalive', 5)),
+        'pidfile': conf.get('pidfile'),
+    }
+    if workers > 1 and not conf.get('message_queue'):
+        log.warn("[http] {} workers without message_queue, socket.io emits stay local to each worker", workers)
+    log.info("[http] gunicorn {}", options)
+    GunicornServer(app, options).run()
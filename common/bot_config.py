@@ -0,0 +1,187 @@
+# encoding:utf-8
+
+import threading
+import time
+from collections import OrderedDict
+from config import common_conf_val
+from common import log
+from common.redis import RedisSingleton, AsyncRedisSingleton
+
+# writers bump this counter (INCR) after editing any sfbot/sfteam/sftool hash
+CONFIG_VERSION_KEY = "sfbot:config:version"
+
+class BotConfig(object):
+    """
+    snapshot of one sfbot/sfteam/sftool hash, loaded with a single HGETALL
+    """
+    def __init__(self, key, data):
+        self.key = key
+        self.data = data
+
+    def exists(self):
+        return len(self.data) > 0
+
+    def get(self, field, default=None):
+        return self.data.get(field, default)
+
+    def _str(self, field, default=None):
+        value = self.data.get(field)
+        if value is None:
+            return default
+        return value.strip()
+
+    def _int(self, field, default=None):
+        value = self.data.get(field)
+        if value is None:
+            return default
+        return int(value.strip())
+
+    # sfbot:org:{org}:bot:{bot}
+    @property
+    def model(self):
+        return self._str('model')
+
+    @property
+    def baidu_key(self):
+        return self._str('baidu_key')
+
+    @property
+    def google_key(self):
+        return self._str('google_key')
+
+    @property
+    def threshold(self):
+        return self._int('threshold')
+
+    @property
+    def character_desc(self):
+        return self.data.get('character_desc')
+
+    # sfteam:org:{org}:team:{team}:bot:{bot} / sfteam:user:{user}:team:{team}:bot:{bot}
+    @property
+    def name(self):
+        return self._str('name', '')
+
+    @property
+    def desc(self):
+        return self._str('desc', '')
+
+    @property
+    def prompt(self):
+        return self._str('prompt', '')
+
+    @property
+    def nokb(self):
+        return self._int('nokb', 0)
+
+    # sfteam:org:{org}:team:{team}:data
+    @property
+    def team_desc(self):
+        return self.data.get('team_desc', '')
+
+    @property
+    def public(self):
+        return self._int('public', 1)
+
+
+class BotConfigCache(object):
+    """
+    per-process cache of bot/teambot config hashes with a short TTL, at most
+    bot_config_cache_size entries, dropped as a whole whenever the shared version stamp changes
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.configs = OrderedDict()
+            cls._instance.lock = threading.Lock()
+            cls._instance.version = None
+            cls._instance.version_checked = 0
+        return cls._instance
+
+    def _version_due(self, current):
+        interval = float(common_conf_val('bot_config_version_interval', 1))
+        if current - self.version_checked < interval:
+            return False
+        self.version_checked = current
+        return True
+
+    def _apply_version(self, version):
+        with self.lock:
+            if version != self.version:
+                if self.version is not None:
+                    log.info("[BOTCFG] version changed {} -> {}, drop {} entries", self.version, version, len(self.configs))
+                self.configs.clear()
+                self.version = version
+
+    def _cached(self, key, current):
+        ttl = float(common_conf_val('bot_config_ttl', 30))
+        with self.lock:
+            entry = self.configs.get(key)
+            if entry is None:
+                return None
+            if current - entry[0] >= ttl:
+                self.configs.pop(key, None)
+                return None
+            return entry[1]
+
+    def _store(self, key, rawdata, current):
+        data = {}
+        for field, value in rawdata.items():
+            data[field.decode()] = value.decode()
+        config = BotConfig(key, data)
+        ttl = float(common_conf_val('bot_config_ttl', 30))
+        size = int(common_conf_val('bot_config_cache_size', 4096))
+        with self.lock:
+            self.configs[key] = (current, config)
+            self.configs.move_to_end(key)
+            # entries are in store order, so expired ones are at the front
+            while len(self.configs) > 0:
+                oldest = next(iter(self.configs.values()))
+                if len(self.configs) <= size and current - oldest[0] < ttl:
+                    break
+                self.configs.popitem(last=False)
+        return config
+
+    def get(self, key):
+        current = time.time()
+        myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
+        if self._version_due(current):
+            self._apply_version(myredis.redis.get(CONFIG_VERSION_KEY))
+        config = self._cached(key, current)
+        if config is not None:
+            return config
+        return self._store(key, myredis.redis.hgetall(key), current)
+
+    async def aget(self, key):
+        """
+        same as get, on the asyncio redis client
+        """
+        current = time.time()
+        myredis = AsyncRedisSingleton(password=common_conf_val('redis_password', ''))
+        if self._version_due(current):
+            self._apply_version(await myredis.redis.get(CONFIG_VERSION_KEY))
+        config = self._cached(key, current)
+        if config is not None:
+            return config
+        return self._store(key, await myredis.redis.hgetall(key), current)
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.configs.clear()
+            else:
+                self.configs.pop(key, None)
+
+    @staticmethod
+    def bump_version():
+        myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
+        return myredis.redis.incr(CONFIG_VERSION_KEY)
+
+
+def bot_config(key):
+    return BotConfigCache().get(key)
+
+async def abot_config(key):
+    return await BotConfigCache().aget(key)
@@ -0,0 +1,94 @@
+# encoding:utf-8
+
+from config import common_conf_val
+from common import log
+from common.session_store import count_tokens, message_tokens, get_encoding
+
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-4o-mini': 128000,
+    'gpt-4o': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-4-32k': 32768,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 16385,
+    'ft:gpt-4o-mini': 128000,
+    'ft:gpt-4o': 128000,
+    'ft:gpt-3.5-turbo': 16385,
+    'ERNIE-Lite-8K': 8192,
+    'gemini-pro': 32760,
+}
+
+CONTEXT_CLOSE = '\n```\n'
+
+def context_window(model):
+    if not model:
+        return None
+    best = None
+    for name, window in MODEL_CONTEXT_WINDOWS.items():
+        if model.startswith(name) and (best is None or len(name) > len(best)):
+            best = name
+    return MODEL_CONTEXT_WINDOWS.get(best)
+
+def prompt_budget(model, context_tokens):
+    """
+    tokens available for the prompt: the configured cap, bounded by the model
+    window minus what is reserved for the completion
+    """
+    budget = context_tokens
+    window = context_window(model)
+    if window is not None:
+        reserve = int(common_conf_val('completion_token_reserve', 1024))
+        budget = min(budget, window - reserve)
+    return budget
+
+def truncate_tokens(text, max_tokens):
+    encoding = get_encoding()
+    return encoding.decode(encoding.encode(text)[:max_tokens])
+
+def pack_context(instructions, chunks, history, query, budget, fenced=None):
+    """
+    allocate the prompt budget across system instructions, context chunks and history
+    :param instructions: system prompt head, including the opening fence when fenced
+    :param chunks: context texts in rank order (QnA answer first, then KB docs by score)
+    :param history: previous turns, oldest first
+    :param fenced: the instructions open a context fence to be closed, defaults to having chunks
+    :return: system prompt, kept history
+    """
+    if fenced is None:
+        fenced = len(chunks) > 0
+    query_tokens = message_tokens({'role': 'user', 'content': query})
+    history_counts = [message_tokens(message) for message in history]
+    history_share = float(common_conf_val('history_token_share', 0.25))
+    history_reserve = min(sum(history_counts), int(budget * history_share))
+
+    system_prompt = instructions
+    if fenced:
+        min_chunk = int(common_conf_val('min_chunk_tokens', 64))
+        system_tokens = message_tokens({'role': 'system', 'content': instructions + CONTEXT_CLOSE})
+        available = budget - 3 - query_tokens - history_reserve - system_tokens
+        packed = []
+        for i, chunk in enumerate(chunks):
+            piece = '\n' + chunk
+            num_tokens = count_tokens(piece)
+            if num_tokens <= available:
+                packed.append(piece)
+                available -= num_tokens
+                continue
+            if available >= min_chunk:
+                packed.append(truncate_tokens(piece, available))
+                log.info("[CONTEXT] chunk {} truncated {} -> {} tokens", i, num_tokens, available)
+                available = 0
+            if len(packed) < len(chunks):
+                log.info("[CONTEXT] {} of {} chunks dropped for budget {}", len(chunks)-len(packed), len(chunks), budget)
+            break
+        system_prompt = instructions + ''.join(packed) + CONTEXT_CLOSE
+
+    # history takes whatever the system prompt left, dropping the oldest turns in pairs
+    history = list(history)
+    num_tokens = 3 + query_tokens + message_tokens({'role': 'system', 'content': system_prompt}) + sum(history_counts)
+    while len(history) > 1 and num_tokens > budget:
+        num_tokens -= history_counts[0] + history_counts[1]
+        del history_counts[0:2]
+        del history[0:2]
+    log.info("[CONTEXT] prompt tokens={} budget={} history={}", num_tokens, budget, len(history))
+    return system_prompt, history
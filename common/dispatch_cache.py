@@ -0,0 +1,77 @@
+# encoding:utf-8
+
+import threading
+import time
+import numpy as np
+from config import common_conf_val
+from common import log
+
+class DispatchCache(object):
+    """
+    semantic cache of find_teambot decisions keyed by (org, team description hash):
+    query embedding -> (agent_id, team_id). each audience of an org (internal/external users,
+    single-team queries) sees its own team description, so each hash keeps its own entries
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.entries = {}
+            cls._instance.lock = threading.Lock()
+            cls._instance.counters = {'hits': 0, 'misses': 0, 'saved_llm_calls': 0}
+        return cls._instance
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.array(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+        return vector
+
+    def lookup(self, orgnum, desc_hash, query_embedding):
+        threshold = float(common_conf_val('dispatch_cache_threshold', 0.95))
+        ttl = float(common_conf_val('dispatch_cache_ttl', 3600))
+        current = time.time()
+        vector = self._normalize(query_embedding)
+        key = (orgnum, desc_hash)
+        with self.lock:
+            entries = [e for e in self.entries.get(key, []) if current - e['time'] < ttl]
+            if len(entries) > 0:
+                self.entries[key] = entries
+            else:
+                self.entries.pop(key, None)
+            if len(entries) > 0:
+                scores = np.stack([e['vector'] for e in entries]) @ vector
+                best = int(np.argmax(scores))
+                if float(scores[best]) >= threshold:
+                    self.counters['hits'] += 1
+                    self.counters['saved_llm_calls'] += 1
+                    entry = entries[best]
+                    log.info("[DISPATCH] cache hit org={} similarity={:.4f} stats={}", orgnum, float(scores[best]), self.counters)
+                    return entry['agent_id'], entry['team_id']
+            self.counters['misses'] += 1
+        return None
+
+    def store(self, orgnum, desc_hash, query_embedding, agent_id, team_id):
+        size = int(common_conf_val('dispatch_cache_size', 500))
+        ttl = float(common_conf_val('dispatch_cache_ttl', 3600))
+        current = time.time()
+        entry = {'vector': self._normalize(query_embedding), 'agent_id': agent_id, 'team_id': team_id, 'time': current}
+        with self.lock:
+            entries = self.entries.setdefault((orgnum, desc_hash), [])
+            entries.append(entry)
+            if len(entries) > size:
+                del entries[:len(entries)-size]
+            # hashes replaced by a team change are never looked up again, let them age out
+            for key in [k for k, v in self.entries.items() if current - v[-1]['time'] >= ttl]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            total = stats['hits'] + stats['misses']
+            stats['hit_rate'] = stats['hits'] / total if total > 0 else 0.0
+            stats['entries'] = sum(len(v) for v in self.entries.values())
+        return stats
@@ -0,0 +1,116 @@
+# encoding:utf-8
+
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+from config import common_conf_val
+from common import log
+from common.redis import RedisSingleton
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+def cached_embeddings(api_key, model="text-embedding-ada-002"):
+    """
+    process-wide cached embeddings for the given model
+    """
+    with _instances_lock:
+        embeddings = _instances.get(model)
+        if embeddings is None:
+            embeddings = CachedEmbeddings(OpenAIEmbeddings(openai_api_key=api_key, model=model), model)
+            _instances[model] = embeddings
+        return embeddings
+
+class CachedEmbeddings(Embeddings):
+    """
+    two-tier embedding cache: in-process LRU in front of a shared redis tier
+    keyed by (model, sha256(text)); vectors are kept as float32 bytes.
+    only queries use the redis tier, documents (replies, paragraphs) rarely repeat
+    and stay in the LRU
+    """
+    def __init__(self, embeddings, model, size=None, ttl=None):
+        self.embeddings = embeddings
+        self.model = model
+        self.size = int(size or common_conf_val('embedding_cache_size', 2048))
+        self.ttl = int(ttl or common_conf_val('embedding_cache_ttl', 604800))
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'lru_hits': 0, 'redis_hits': 0, 'misses': 0}
+
+    def cache_key(self, text):
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return "emb:{}:{}".format(self.model, digest)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['lru_size'] = len(self.lru)
+        return stats
+
+    def _lru_get(self, key):
+        with self.lock:
+            blob = self.lru.get(key)
+            if blob is not None:
+                self.lru.move_to_end(key)
+                self.counters['lru_hits'] += 1
+            return blob
+
+    def _lru_put(self, key, blob):
+        with self.lock:
+            self.lru[key] = blob
+            self.lru.move_to_end(key)
+            while len(self.lru) > self.size:
+                self.lru.popitem(last=False)
+
+    def _count(self, name, num):
+        with self.lock:
+            self.counters[name] += num
+
+    def embed_documents(self, texts):
+        return self._embed(texts, shared=False)
+
+    def embed_query(self, text):
+        return self._embed([text], shared=True)[0]
+
+    def _embed(self, texts, shared):
+        keys = [self.cache_key(text) for text in texts]
+        blobs = [self._lru_get(key) for key in keys]
+
+        missing = [i for i, blob in enumerate(blobs) if blob is None]
+        if shared and len(missing) > 0:
+            try:
+                myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
+                found = myredis.redis.mget([keys[i] for i in missing])
+                for i, blob in zip(missing, found):
+                    if blob is not None:
+                        blobs[i] = blob
+                        self._lru_put(keys[i], blob)
+                self._count('redis_hits', len([blob for blob in found if blob is not None]))
+            except Exception as e:
+                log.warn("[EMBED] redis tier unavailable: {}", e)
+
+        missing = [i for i, blob in enumerate(blobs) if blob is None]
+        if len(missing) > 0:
+            self._count('misses', len(missing))
+            vectors = self.embeddings.embed_documents([texts[i] for i in missing])
+            fresh = {}
+            for i, vector in zip(missing, vectors):
+                blob = np.array(vector).astype(dtype=np.float32).tobytes()
+                blobs[i] = blob
+                fresh[keys[i]] = blob
+                self._lru_put(keys[i], blob)
+            if shared:
+                try:
+                    myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
+                    pipe = myredis.redis.pipeline(transaction=False)
+                    for key, blob in fresh.items():
+                        pipe.set(key, blob, ex=self.ttl)
+                    pipe.execute()
+                except Exception as e:
+                    log.warn("[EMBED] redis tier write failed: {}", e)
+
+        log.debug("[EMBED] cache stats={}", self.stats())
+        return [np.frombuffer(blob, dtype=np.float32).tolist() for blob in blobs]
@@ -0,0 +1,136 @@
+# encoding:utf-8
+
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.retry import Retry
+from config import common_conf_val
+from common import log
+
+class GraphQLClient(object):
+    """
+    keep-alive client of the internal graphql endpoint, shared by all threads of the process.
+    only failed connects and 502/503 responses are retried, so a mutation that reached
+    the server is never sent twice.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super().__new__(cls)
+                cls._instance._setup()
+        return cls._instance
+
+    def _setup(self):
+        self.url = common_conf_val('graphql_url', 'http://127.0.0.1:5000/graphql')
+        self.timeout = (float(common_conf_val('graphql_connect_timeout', 2)), float(common_conf_val('graphql_timeout', 10)))
+        retries = Retry(
+            total=int(common_conf_val('graphql_retries', 3)),
+            connect=int(common_conf_val('graphql_retries', 3)),
+            read=0,
+            status=int(common_conf_val('graphql_retries', 3)),
+            # a 504 may come after the mutation ran, only statuses of a request never handled are retried
+            status_forcelist=[502, 503],
+            allowed_methods=None,
+            backoff_factor=float(common_conf_val('graphql_backoff', 0.2)),
+            raise_on_status=False,
+        )
+        pool_size = int(common_conf_val('graphql_pool_size', 16))
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Type": "application/json"})
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries))
+
+    def post(self, query, variables=None):
+        """
+        :return: the http response
+        """
+        return self.session.post(self.url, json={"query": query, "variables": variables or {}}, timeout=self.timeout)
+
+    def mutate(self, name, args, fields=''):
+        """
+        run one mutation
+        :param args: argument list as graphql source, e.g: 'id:1, category:"qa"'
+        :return: result of the mutation field, None on failure
+        """
+        return self.mutate_batch([(name, args, fields)])[0]
+
+    def mutate_batch(self, mutations):
+        """
+        send several mutations in one request, each under its own alias (m0, m1, ...)
+        :param mutations: list of (name, args, fields)
+        :return: list of results in the same order, None for failed ones
+        """
+        results, failed = self.execute_batch(mutations)
+        for i in failed:
+            results[i] = None
+        return results
+
+    @staticmethod
+    def _not_sent(e):
+        if isinstance(e, requests.exceptions.ConnectTimeout):
+            return True
+        if isinstance(e, requests.exceptions.ConnectionError) and len(e.args) > 0:
+            return isinstance(getattr(e.args[0], 'reason', e.args[0]), NewConnectionError)
+        return False
+
+    def execute_batch(self, mutations):
+        """
+        like mutate_batch, telling apart the mutations known not to be applied
+        :return: (results, failed) with failed the indexes that errored or were never
+                 received; they are safe to send again. a request whose outcome is
+                 unknown (e.g. a read timeout) reports nothing as failed.
+        """
+        if len(mutations) == 0:
+            return [], []
+        names = '_'.join(sorted(set(m[0] for m in mutations)))
+        parts = []
+        for i, (name, args, fields) in enumerate(mutations):
+            selection = " {{ {} }}".format(fields) if fields else ""
+            parts.append("m{}: {}( {} ){}".format(i, name, args, selection))
+        query = "mutation {} {{ {} }}".format(names, ' '.join(parts))
+        everything = list(range(len(mutations)))
+        try:
+            gqlresp = self.post(query)
+        except Exception as e:
+            if self._not_sent(e):
+                log.warn("GQL/{}: not sent: {}", names, e)
+                return [None] * len(mutations), everything
+            log.warn("GQL/{}: outcome unknown, not retried: {}", names, e)
+            return [None] * len(mutations), []
+        log.info("GQL/{}: {} mutations {}", names, len(mutations), gqlresp.status_code)
+        log.debug("GQL/{}: {} {}", names, query, gqlresp.text.strip())
+        if gqlresp.status_code in (502, 503):
+            return [None] * len(mutations), everything
+        try:
+            body = gqlresp.json()
+        except ValueError:
+            log.warn("GQL/{}: status {}, outcome unknown", names, gqlresp.status_code)
+            return [None] * len(mutations), []
+        data = body.get('data') or {}
+        results = [data.get("m{}".format(i)) for i in range(len(mutations))]
+        errors = body.get('errors') or []
+        if body.get('data') is None:
+            if any(error.get('path') for error in errors):
+                # a non-null field failed during execution, the aliases before it already ran
+                log.warn("GQL/{}: execution error with null data, outcome unknown", names)
+                return results, []
+            # rejected before execution (parse/validation errors carry no path), nothing was applied
+            return results, everything
+        # a null result is a failure only when the errors point at its alias
+        failed = set()
+        for error in errors:
+            path = error.get('path') or []
+            if len(path) > 0 and isinstance(path[0], str) and path[0].startswith('m') and path[0][1:].isdigit():
+                failed.add(int(path[0][1:]))
+        return results, sorted(i for i in failed if i < len(mutations))
+
+
+def gql_string(value):
+    """
+    quote a python string as a graphql string literal
+    """
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
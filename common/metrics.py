@@ -0,0 +1,44 @@
+# encoding:utf-8
+
+import threading
+import time
+from config import common_conf_val
+from common import log
+
+_sources = {}
+_lock = threading.Lock()
+_reporter = None
+
+def register(name, stats):
+    """
+    report stats() of a cache or store in the periodic [METRICS] log line
+    """
+    with _lock:
+        _sources[name] = stats
+    _ensure_reporter()
+
+def snapshot():
+    with _lock:
+        sources = dict(_sources)
+    result = {}
+    for name, stats in sources.items():
+        try:
+            result[name] = stats()
+        except Exception as e:
+            result[name] = {'error': str(e)}
+    return result
+
+def _ensure_reporter():
+    global _reporter
+    interval = float(common_conf_val('metrics_log_interval', 60))
+    if interval <= 0:
+        return
+    with _lock:
+        if _reporter is None or not _reporter.is_alive():
+            _reporter = threading.Thread(target=_report_loop, args=(interval,), name='metrics', daemon=True)
+            _reporter.start()
+
+def _report_loop(interval):
+    while True:
+        time.sleep(interval)
+        log.info("[METRICS] {}", snapshot())
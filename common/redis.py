@@ -1,5 +1,7 @@
 import redis
+import redis.asyncio as aioredis
 from redis.commands.search.query import Query
+from redis.commands.search.result import Result
 import numpy as np
 from typing import List
 
@@ -29,24 +31,94 @@ class RedisSingleton:
             filter = '[0 1]'
         return f'(@orgid:{orgid} @chatbots:{{ {chatbotid} }} @public:{filter} @{field_name}:"{value}")'
 
-    def ft_search(
-        self,
-        embedded_query,
-        index_name: str = "sflow-index",
+    @staticmethod
+    def vector_bytes(embedded_query) -> bytes:
+        if isinstance(embedded_query, bytes):
+            return embedded_query
+        return np.array(embedded_query).astype(dtype=np.float32).tobytes()
+
+    @staticmethod
+    def knn_query(
         vector_field: str = "text_vector",
         return_fields: list = ["id", "orgid", "category", "vector_score"],
         hybrid_fields: str = "*",
         k: int = 3,
         offset: int = 0,
-    ) -> List[dict]:
+    ) -> Query:
         base_query = f'{hybrid_fields}=>[KNN {k+offset} @{vector_field} $vector AS vector_score]'
-        query = (
+        return (
             Query(base_query)
                .return_fields(*return_fields)
                .sort_by("vector_score")
                .paging(offset, k)
                .dialect(2)
         )
-        params_dict = {"vector": np.array(embedded_query).astype(dtype=np.float32).tobytes()}
+
+    def ft_search(
+        self,
+        embedded_query,
+        index_name: str = "sflow-index",
+        vector_field: str = "text_vector",
+        return_fields: list = ["id", "orgid", "category", "vector_score"],
+        hybrid_fields: str = "*",
+        k: int = 3,
+        offset: int = 0,
+    ) -> List[dict]:
+        query = self.knn_query(vector_field, return_fields, hybrid_fields, k, offset)
+        params_dict = {"vector": self.vector_bytes(embedded_query)}
         results = self._instance.redis.ft(index_name).search(query, params_dict)
         return results.docs
+
+    def multi_search(
+        self,
+        embedded_query,
+        specs: List[dict],
+        index_name: str = "sflow-index",
+    ) -> List[List[dict]]:
+        """
+        run several KNN queries for one vector in a single pipelined round trip
+        :param specs: [{'vector_field':..., 'hybrid_fields':..., 'k':..., 'offset':..., 'return_fields':...}]
+        :return: result docs grouped by spec, in order
+        """
+        if len(specs) == 0:
+            return []
+        params_dict = {"vector": self.vector_bytes(embedded_query)}
+        pipe = self._instance.redis.pipeline(transaction=False)
+        queries = []
+        for spec in specs:
+            query = self.knn_query(**spec)
+            queries.append(query)
+            pipe.ft(index_name).search(query, params_dict)
+        rows = pipe.execute()
+        return [
+            Result(row, not query._no_content, has_payload=query._with_payloads, with_scores=query._with_scores).docs
+            for query, row in zip(queries, rows)
+        ]
+
+    def hydrate(self, docs, fields: List[str]) -> List[dict]:
+        """
+        fetch hash fields of search hits in one pipelined HMGET batch
+        :return: one {field: bytes|None} dict per doc, in order
+        """
+        if len(docs) == 0:
+            return []
+        pipe = self._instance.redis.pipeline(transaction=False)
+        for doc in docs:
+            pipe.hmget(doc.id, fields)
+        rows = pipe.execute()
+        return [dict(zip(fields, row)) for row in rows]
+
+
+class AsyncRedisSingleton:
+    """
+    asyncio counterpart of RedisSingleton, for code running on the stream event loop
+    """
+    _instance = None
+    _pool = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+            cls._pool = aioredis.ConnectionPool(*args, **kwargs)
+            cls._instance.redis = aioredis.Redis(connection_pool=cls._pool)
+        return cls._instance
@@ -0,0 +1,234 @@
+# encoding:utf-8
+
+import hashlib
+import json
+import sys
+import threading
+import time
+import tiktoken
+from collections import OrderedDict
+from config import common_conf_val
+from common import log
+from common.redis import RedisSingleton
+
+_token_counts = OrderedDict()
+_token_lock = threading.Lock()
+_encoding = None
+
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding
+
+def _token_key(text):
+    return hashlib.md5(text.encode('utf-8')).digest()
+
+def remember_tokens(text, num_tokens):
+    size = int(common_conf_val('token_cache_size', 10000))
+    with _token_lock:
+        _token_counts[_token_key(text)] = num_tokens
+        while len(_token_counts) > size:
+            _token_counts.popitem(last=False)
+
+def count_tokens(text):
+    """
+    cl100k_base token count of text, memoized by content
+    """
+    key = _token_key(text)
+    with _token_lock:
+        num_tokens = _token_counts.get(key)
+        if num_tokens is not None:
+            _token_counts.move_to_end(key)
+            return num_tokens
+    num_tokens = len(get_encoding().encode(text))
+    remember_tokens(text, num_tokens)
+    return num_tokens
+
+def message_tokens(message):
+    """
+    chat-format token count of one message (4 per message, -1 for a name)
+    """
+    num_tokens = 4
+    for key, value in message.items():
+        num_tokens += count_tokens(value)
+        if key == "name":
+            num_tokens -= 1
+    return num_tokens
+
+def messages_nbytes(messages):
+    nbytes = 0
+    for message in messages:
+        for value in message.values():
+            nbytes += sys.getsizeof(value)
+    return nbytes
+
+class MemorySessionStore(object):
+    """
+    per-process conversation store with LRU max-entries, idle TTL and a memory ceiling
+    """
+    def __init__(self, max_entries=None, idle_ttl=None, max_bytes=None):
+        self.max_entries = int(max_entries or common_conf_val('session_max_entries', 10000))
+        self.idle_ttl = float(idle_ttl or common_conf_val('session_idle_ttl', 86400))
+        self.max_bytes = int(max_bytes or common_conf_val('session_max_bytes', 256*1024*1024))
+        self.sessions = OrderedDict()
+        self.nbytes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        """
+        :return: the message list of user_id, empty if unknown or expired
+        """
+        with self.lock:
+            entry = self.sessions.get(user_id)
+            if entry is None:
+                return []
+            if time.time() - entry['time'] > self.idle_ttl:
+                self._drop(user_id)
+                return []
+            self.sessions.move_to_end(user_id)
+            return entry['messages']
+
+    def put(self, user_id, messages, appended=None):
+        """
+        :param appended: trailing messages that are new since get, only used by the redis store
+        """
+        nbytes = messages_nbytes(messages)
+        with self.lock:
+            if user_id in self.sessions:
+                self._drop(user_id, evicted=False)
+            self.sessions[user_id] = {'messages': messages, 'time': time.time(), 'nbytes': nbytes}
+            self.nbytes += nbytes
+            self._evict()
+
+    def append(self, user_id, message):
+        """
+        append to an existing conversation only
+        """
+        with self.lock:
+            entry = self.sessions.get(user_id)
+            if entry is None or len(entry['messages']) == 0:
+                return False
+            entry['messages'].append(message)
+            message_tokens(message)
+            nbytes = messages_nbytes([message])
+            entry['nbytes'] += nbytes
+            entry['time'] = time.time()
+            self.nbytes += nbytes
+            self.sessions.move_to_end(user_id)
+            self._evict()
+            return True
+
+    def clear(self, user_id):
+        with self.lock:
+            if user_id in self.sessions:
+                self._drop(user_id, evicted=False)
+
+    def stats(self):
+        with self.lock:
+            return {'sessions': len(self.sessions), 'bytes': self.nbytes, 'evictions': self.evictions}
+
+    def _drop(self, user_id, evicted=True):
+        entry = self.sessions.pop(user_id)
+        self.nbytes -= entry['nbytes']
+        if evicted:
+            self.evictions += 1
+
+    def _evict(self):
+        current = time.time()
+        while len(self.sessions) > 0:
+            user_id, entry = next(iter(self.sessions.items()))
+            if current - entry['time'] > self.idle_ttl or len(self.sessions) > self.max_entries or self.nbytes > self.max_bytes:
+                self._drop(user_id)
+                log.debug("[SESSION] evict {} stats={}", user_id, {'sessions': len(self.sessions), 'bytes': self.nbytes})
+            else:
+                break
+
+
+class RedisSessionStore(object):
+    """
+    conversation log shared by all workers: one redis list per user of compact
+    {role, content, tokens} entries, trimmed server-side and expired when idle.
+    system prompts are rebuilt on every query and are not stored.
+    """
+    def __init__(self, max_messages=None, idle_ttl=None):
+        self.max_messages = int(max_messages or common_conf_val('session_max_messages', 40))
+        self.idle_ttl = int(idle_ttl or common_conf_val('session_idle_ttl', 86400))
+        self.counters = {'reads': 0, 'writes': 0, 'bytes': 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def session_key(user_id):
+        return "sfbot:session:{}".format(user_id)
+
+    @staticmethod
+    def _encode(message):
+        content = message['content']
+        return json.dumps({'role': message['role'], 'content': content, 'tokens': count_tokens(content)}, ensure_ascii=False)
+
+    def _count(self, name, num):
+        with self.lock:
+            self.counters[name] += num
+
+    def get(self, user_id):
+        myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
+        rows = myredis.redis.lrange(self.session_key(user_id), 0, -1)
+        self._count('reads', 1)
+        messages = []
+        for row in rows:
+            entry = json.loads(row)
+            if entry.get('tokens') is not None:
+                remember_tokens(entry['content'], entry['tokens'])
+            messages.append({'role': entry['role'], 'content': entry['content']})
+        return messages
+
+    def put(self, user_id, messages, appended=None):
+        """
+        :param appended: trailing messages that are new since get; when given only they are
+                         pushed, otherwise the stored log is replaced by messages
+        """
+        key = self.session_key(user_id)
+        myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
+        pipe = myredis.redis.pipeline(transaction=True)
+        if appended is not None:
+            rows = [self._encode(m) for m in appended if m['role'] != 'system']
+        else:
+            rows = [self._encode(m) for m in messages if m['role'] != 'system']
+            pipe.delete(key)
+        if len(rows) > 0:
+            pipe.rpush(key, *rows)
+            pipe.ltrim(key, -self.max_messages, -1)
+            pipe.expire(key, self.idle_ttl)
+        pipe.execute()
+        self._count('writes', 1)
+        self._count('bytes', sum(len(row) for row in rows))
+
+    def append(self, user_id, message):
+        key = self.session_key(user_id)
+        row = self._encode(message)
+        myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
+        pipe = myredis.redis.pipeline(transaction=True)
+        pipe.rpushx(key, row)
+        pipe.ltrim(key, -self.max_messages, -1)
+        pipe.expire(key, self.idle_ttl)
+        result = pipe.execute()
+        self._count('writes', 1)
+        self._count('bytes', len(row))
+        return result[0] > 0
+
+    def clear(self, user_id):
+        myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
+        myredis.redis.delete(self.session_key(user_id))
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+def create_session_store():
+    backend = common_conf_val('session_backend', 'memory')
+    log.info("[SESSION] backend={}", backend)
+    if backend == 'redis':
+        return RedisSessionStore()
+    return MemorySessionStore()
@@ -0,0 +1,168 @@
+# encoding:utf-8
+
+import atexit
+import json
+import queue
+import threading
+import time
+from config import common_conf_val
+from common import log
+from common.redis import RedisSingleton
+
+SIDE_EFFECT_KEY = "sfbot:side_effects"
+SIDE_EFFECT_FAILED_KEY = "sfbot:side_effects:failed"
+
+class SideEffectQueue(object):
+    """
+    background writer for work the user does not wait on (chat history, hit counts, notifications, stats).
+    tasks are (kind, payload) with a json-serializable payload; a worker thread drains them in batches
+    and calls the handler registered for each kind with the list of payloads, retrying only the
+    payloads the handler reports as failed.
+    with side_effect_backend "redis" tasks are kept in a redis list shared by all workers, so they
+    survive a restart; otherwise they live in a bounded in-process queue.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super().__new__(cls)
+                cls._instance._setup()
+        return cls._instance
+
+    def _setup(self):
+        self.backend = common_conf_val('side_effect_backend', 'memory')
+        self.batch_size = int(common_conf_val('side_effect_batch', 50))
+        self.retries = int(common_conf_val('side_effect_retries', 3))
+        self.tasks = queue.Queue(maxsize=int(common_conf_val('side_effect_queue_size', 10000)))
+        self.handlers = {}
+        self.worker = None
+        self.counters = {'submitted': 0, 'done': 0, 'failed': 0, 'inline': 0}
+        self.counter_lock = threading.Lock()
+        atexit.register(self.drain)
+
+    def register(self, kind, handler):
+        """
+        :param handler: called with the list of payloads of one batch, returns the payloads that
+                        were not applied and may be sent again; raise only if nothing was sent
+        """
+        self.handlers[kind] = handler
+
+    def submit(self, kind, payload):
+        self._ensure_worker()
+        self._count('submitted', 1)
+        if self.backend == 'redis':
+            try:
+                myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
+                myredis.redis.rpush(SIDE_EFFECT_KEY, json.dumps([kind, payload]))
+                return
+            except Exception as e:
+                log.warn("[SIDE] redis push failed, run inline: {}", e)
+        else:
+            try:
+                self.tasks.put_nowait((kind, payload))
+                return
+            except queue.Full:
+                log.warn("[SIDE] queue full, run {} inline", kind)
+        # never lose a task: a full queue or an unreachable redis falls back to the caller
+        self._count('inline', 1)
+        self._run(kind, [payload])
+
+    def stats(self):
+        with self.counter_lock:
+            stats = dict(self.counters)
+        stats['queued'] = self.tasks.qsize()
+        return stats
+
+    def drain(self, timeout=5):
+        """
+        run what is left in the in-process queue, at exit
+        """
+        deadline = time.time() + timeout
+        while not self.tasks.empty() and time.time() < deadline:
+            self._process(self._take_memory(block=False))
+
+    def _count(self, name, num):
+        with self.counter_lock:
+            self.counters[name] += num
+
+    def _ensure_worker(self):
+        # the worker thread does not survive a fork, start one per process
+        with self._lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._loop, name='side-effects', daemon=True)
+                self.worker.start()
+
+    def _take_memory(self, block=True):
+        batch = []
+        try:
+            batch.append(self.tasks.get(block=block, timeout=1 if block else None))
+            while len(batch) < self.batch_size:
+                batch.append(self.tasks.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _take_redis(self):
+        myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
+        first = myredis.redis.blpop(SIDE_EFFECT_KEY, timeout=1)
+        if first is None:
+            return []
+        rows = [first[1]]
+        if self.batch_size > 1:
+            rows.extend(myredis.redis.lpop(SIDE_EFFECT_KEY, self.batch_size-1) or [])
+        return [tuple(json.loads(row)) for row in rows]
+
+    def _loop(self):
+        while True:
+            try:
+                if self.backend == 'redis':
+                    batch = self._take_redis()
+                else:
+                    batch = self._take_memory()
+                self._process(batch)
+            except Exception as e:
+                log.exception(e)
+                time.sleep(1)
+
+    def _process(self, batch):
+        groups = {}
+        for kind, payload in batch:
+            groups.setdefault(kind, []).append(payload)
+        for kind, payloads in groups.items():
+            self._run(kind, payloads)
+
+    def _run(self, kind, payloads):
+        handler = self.handlers.get(kind)
+        if handler is None:
+            log.warn("[SIDE] no handler for {}, {} dropped", kind, len(payloads))
+            self._count('failed', len(payloads))
+            return
+        for attempt in range(self.retries+1):
+            try:
+                failed = handler(payloads) or []
+            except Exception as e:
+                log.warn("[SIDE] {} x{} attempt {} raised: {}", kind, len(payloads), attempt+1, e)
+                failed = payloads
+            self._count('done', len(payloads) - len(failed))
+            payloads = failed
+            if len(payloads) == 0:
+                return
+            log.warn("[SIDE] {} attempt {}: {} failed", kind, attempt+1, len(payloads))
+            if attempt < self.retries:
+                time.sleep(min(0.5 * 2 ** attempt, 10))
+        self._count('failed', len(payloads))
+        if self.backend == 'redis':
+            try:
+                myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
+                myredis.redis.rpush(SIDE_EFFECT_FAILED_KEY, *[json.dumps([kind, p]) for p in payloads])
+            except Exception as e:
+                log.exception(e)
+
+
+def submit(kind, payload):
+    SideEffectQueue().submit(kind, payload)
+
+def register(kind, handler):
+    SideEffectQueue().register(kind, handler)
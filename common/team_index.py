@@ -0,0 +1,233 @@
+# encoding:utf-8
+
+import argparse
+import threading
+import time
+import config
+from config import common_conf_val
+from common import log
+from common.redis import RedisSingleton
+
+# maintained secondary indexes over sfteam:org:{org}:team:{team}:data and
+# sfteam:org:{org}:team:{team}:bot:{bot}, so team lookups never need KEYS.
+# the sfteam hashes are written by the admin service, which should call the
+# incremental helpers below; until it does, a background thread (or this module
+# run from cron) rebuilds each index with SCAN once team_index_ttl has passed,
+# and misses are repaired with a targeted SCAN whose negative result is cached
+TEAMS_KEY = "sfteam:org:{}:index:teams"
+BOTTEAM_KEY = "sfteam:org:{}:index:botteam"
+BUILT_KEY = "sfteam:org:{}:index:built"
+BUILDING_KEY = "sfteam:org:{}:index:building"
+NOBOT_KEY = "sfteam:org:{}:index:nobot:{}"
+
+_orgs = set()
+_lock = threading.Lock()
+_refresher = None
+
+def _redis():
+    return RedisSingleton(password=common_conf_val('redis_password', '')).redis
+
+def _ttl():
+    return int(common_conf_val('team_index_ttl', 300))
+
+def _watch(orgnum):
+    """
+    keep the index of an org fresh from a background thread of this process
+    """
+    global _refresher
+    with _lock:
+        _orgs.add(str(orgnum))
+        if _ttl() <= 0:
+            return
+        if _refresher is None or not _refresher.is_alive():
+            _refresher = threading.Thread(target=_refresh_loop, name='team-index', daemon=True)
+            _refresher.start()
+
+def _refresh_loop():
+    while True:
+        time.sleep(min(_ttl(), 30))
+        with _lock:
+            orgs = list(_orgs)
+        for orgnum in orgs:
+            try:
+                built = _redis().get(BUILT_KEY.format(orgnum))
+                if built is None or time.time() - int(built) >= _ttl():
+                    TeamIndex.try_rebuild(orgnum)
+            except Exception as e:
+                log.warn("[TEAMIDX] org={} refresh failed: {}", orgnum, e)
+
+def parse_team_key(key):
+    """
+    :return: (orgnum, teamid, botid) with botid None for team data keys, or None
+    """
+    parts = key.split(':')
+    if len(parts) < 6 or parts[0] != 'sfteam' or parts[1] != 'org' or parts[3] != 'team':
+        return None
+    if len(parts) == 6 and parts[5] == 'data':
+        return parts[2], parts[4], None
+    if len(parts) == 7 and parts[5] == 'bot':
+        return parts[2], parts[4], parts[6]
+    return None
+
+class TeamIndex(object):
+    @staticmethod
+    def rebuild(orgnum):
+        myredis = _redis()
+        teams = set()
+        botteam = {}
+        for key in myredis.scan_iter(match="sfteam:org:{}:team:*".format(orgnum), count=1000):
+            parsed = parse_team_key(key.decode())
+            if parsed is None:
+                continue
+            _, teamid, botid = parsed
+            if botid is None:
+                teams.add(teamid)
+            else:
+                botteam[botid] = teamid
+        pipe = myredis.pipeline(transaction=True)
+        pipe.delete(TEAMS_KEY.format(orgnum), BOTTEAM_KEY.format(orgnum))
+        if len(teams) > 0:
+            pipe.sadd(TEAMS_KEY.format(orgnum), *teams)
+        if len(botteam) > 0:
+            pipe.hset(BOTTEAM_KEY.format(orgnum), mapping=botteam)
+        pipe.set(BUILT_KEY.format(orgnum), int(time.time()))
+        pipe.execute()
+        log.info("[TEAMIDX] org={} rebuilt: {} teams, {} bots", orgnum, len(teams), len(botteam))
+        return len(teams), len(botteam)
+
+    @staticmethod
+    def rebuild_all():
+        orgs = set()
+        for key in _redis().scan_iter(match="sfteam:org:*:team:*", count=1000):
+            parsed = parse_team_key(key.decode())
+            if parsed is not None:
+                orgs.add(parsed[0])
+        for orgnum in sorted(orgs):
+            TeamIndex.try_rebuild(orgnum)
+        return len(orgs)
+
+    @staticmethod
+    def try_rebuild(orgnum):
+        """
+        rebuild unless another worker already is
+        :return: True if this call rebuilt the index
+        """
+        myredis = _redis()
+        if not myredis.set(BUILDING_KEY.format(orgnum), 1, nx=True, ex=int(common_conf_val('team_index_build_timeout', 60))):
+            return False
+        try:
+            TeamIndex.rebuild(orgnum)
+        finally:
+            myredis.delete(BUILDING_KEY.format(orgnum))
+        return True
+
+    @staticmethod
+    def ensure(orgnum):
+        """
+        only the first use of an org builds on the request path, later rebuilds run in the background
+        """
+        _watch(orgnum)
+        myredis = _redis()
+        if myredis.exists(BUILT_KEY.format(orgnum)):
+            return
+        if TeamIndex.try_rebuild(orgnum):
+            return
+        # another worker is building, wait for it rather than scanning too
+        deadline = time.time() + float(common_conf_val('team_index_wait', 5))
+        while time.time() < deadline and not myredis.exists(BUILT_KEY.format(orgnum)):
+            time.sleep(0.1)
+
+    @staticmethod
+    def teams(orgnum):
+        TeamIndex.ensure(orgnum)
+        members = _redis().smembers(TEAMS_KEY.format(orgnum))
+        return sorted(int(m.decode()) for m in members)
+
+    @staticmethod
+    def team_of_bot(orgnum, botid):
+        TeamIndex.ensure(orgnum)
+        teamid = _redis().hget(BOTTEAM_KEY.format(orgnum), str(botid))
+        if teamid is None:
+            return TeamIndex.repair_bot(orgnum, botid)
+        return int(teamid.decode())
+
+    @staticmethod
+    def repair_bot(orgnum, botid):
+        """
+        look a bot missing from the index up with SCAN and add it; a bot without a team
+        is remembered for team_index_ttl so its messages do not scan again
+        :return: its teamid, 0 if the bot has no team
+        """
+        myredis = _redis()
+        if myredis.exists(NOBOT_KEY.format(orgnum, botid)):
+            return 0
+        for key in myredis.scan_iter(match="sfteam:org:{}:team:*:bot:{}".format(orgnum, botid), count=1000):
+            parsed = parse_team_key(key.decode())
+            if parsed is None:
+                continue
+            _, teamid, _ = parsed
+            pipe = myredis.pipeline(transaction=True)
+            pipe.hset(BOTTEAM_KEY.format(orgnum), str(botid), teamid)
+            pipe.sadd(TEAMS_KEY.format(orgnum), teamid)
+            pipe.execute()
+            log.info("[TEAMIDX] org={} bot={} repaired: team {}", orgnum, botid, teamid)
+            return int(teamid)
+        myredis.set(NOBOT_KEY.format(orgnum, botid), 1, ex=_ttl() if _ttl() > 0 else 300)
+        return 0
+
+    @staticmethod
+    def repair_team(orgnum, teamid):
+        """
+        re-check an indexed team whose data hash is gone: drop it, or re-add its bots if it still has keys
+        """
+        TeamIndex.remove_team(orgnum, teamid)
+        myredis = _redis()
+        for key in myredis.scan_iter(match="sfteam:org:{}:team:{}:*".format(orgnum, teamid), count=1000):
+            parsed = parse_team_key(key.decode())
+            if parsed is None:
+                continue
+            _, _, botid = parsed
+            if botid is None:
+                TeamIndex.add_team(orgnum, teamid)
+            else:
+                TeamIndex.add_bot(orgnum, teamid, botid)
+        log.info("[TEAMIDX] org={} team={} repaired", orgnum, teamid)
+
+    # incremental updates, called by whoever creates/deletes team keys
+    @staticmethod
+    def add_team(orgnum, teamid):
+        _redis().sadd(TEAMS_KEY.format(orgnum), str(teamid))
+
+    @staticmethod
+    def remove_team(orgnum, teamid):
+        myredis = _redis()
+        botteam = myredis.hgetall(BOTTEAM_KEY.format(orgnum))
+        bots = [bot for bot, team in botteam.items() if team.decode() == str(teamid)]
+        pipe = myredis.pipeline(transaction=True)
+        pipe.srem(TEAMS_KEY.format(orgnum), str(teamid))
+        if len(bots) > 0:
+            pipe.hdel(BOTTEAM_KEY.format(orgnum), *bots)
+        pipe.execute()
+
+    @staticmethod
+    def add_bot(orgnum, teamid, botid):
+        pipe = _redis().pipeline(transaction=True)
+        pipe.hset(BOTTEAM_KEY.format(orgnum), str(botid), str(teamid))
+        pipe.delete(NOBOT_KEY.format(orgnum, botid))
+        pipe.execute()
+
+    @staticmethod
+    def remove_bot(orgnum, botid):
+        _redis().hdel(BOTTEAM_KEY.format(orgnum), str(botid))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="config.json path", type=str, default="./config.json")
+    parser.add_argument("--org", help="rebuild the index of one org only", type=str, default=None)
+    args = parser.parse_args()
+    config.load_config(args.config)
+    if args.org:
+        TeamIndex.try_rebuild(args.org)
+    else:
+        log.info("[TEAMIDX] rebuilt {} orgs", TeamIndex.rebuild_all())
@@ -0,0 +1,99 @@
+# encoding:utf-8
+
+import atexit
+import threading
+import time
+from datetime import datetime
+from config import common_conf_val
+from common import log
+from common.redis import RedisSingleton
+
+class UsageStats(object):
+    """
+    monthly usage accounting of bots, counted locally and flushed as HINCRBY in one pipeline:
+      sfbot:org:{org}:bot:{bot}                  stat_{YYYYMM} (requests), stat_{YYYYMM}_{prompt|completion|total}_tokens
+      sfbot:org:{org}:bot:{bot}:usage:{YYYYMM}   {model}:requests, {model}:{prompt|completion|total}_tokens
+    increments are atomic on the server, so concurrent workers never lose counts
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super().__new__(cls)
+                cls._instance.pending = {}
+                cls._instance.lock = threading.Lock()
+                cls._instance.flusher = None
+                cls._instance.counters = {'flushes': 0, 'increments': 0, 'errors': 0}
+                atexit.register(cls._instance.flush)
+        return cls._instance
+
+    def _add(self, key, field, amount):
+        if amount:
+            self.pending[(key, field)] = self.pending.get((key, field), 0) + int(amount)
+
+    def record(self, sfbot_key, model_name, prompt_tokens=0, completion_tokens=0, used_tokens=0):
+        month = datetime.now().strftime("%Y%m")
+        momkey = 'stat_' + month
+        usage_key = "{}:usage:{}".format(sfbot_key, month)
+        model_name = model_name or 'auto'
+        with self.lock:
+            self._add(sfbot_key, momkey, 1)
+            self._add(sfbot_key, momkey + '_prompt_tokens', prompt_tokens)
+            self._add(sfbot_key, momkey + '_completion_tokens', completion_tokens)
+            self._add(sfbot_key, momkey + '_total_tokens', used_tokens)
+            self._add(usage_key, model_name + ':requests', 1)
+            self._add(usage_key, model_name + ':prompt_tokens', prompt_tokens)
+            self._add(usage_key, model_name + ':completion_tokens', completion_tokens)
+            self._add(usage_key, model_name + ':total_tokens', used_tokens)
+            npending = len(self.pending)
+        if npending >= int(common_conf_val('usage_flush_size', 500)):
+            self.flush()
+        else:
+            self._ensure_flusher()
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        if len(pending) == 0:
+            return
+        try:
+            myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
+            pipe = myredis.redis.pipeline(transaction=False)
+            entries = list(pending.items())
+            for (key, field), amount in entries:
+                pipe.hincrby(key, field, amount)
+            results = pipe.execute(raise_on_error=False)
+            # a command error (e.g. a non-integer field) would fail again, report and drop it
+            for ((key, field), amount), result in zip(entries, results):
+                if isinstance(result, Exception):
+                    log.warn("[USAGE] HINCRBY {} {} {} failed: {}", key, field, amount, result)
+            with self.lock:
+                self.counters['flushes'] += 1
+                self.counters['increments'] += len(entries)
+        except Exception as e:
+            # connection failures keep the counts for the next flush
+            log.warn("[USAGE] flush of {} counters failed: {}", len(pending), e)
+            with self.lock:
+                self.counters['errors'] += 1
+                for entry, amount in pending.items():
+                    self.pending[entry] = self.pending.get(entry, 0) + amount
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['pending'] = len(self.pending)
+        return stats
+
+    def _ensure_flusher(self):
+        with self._lock:
+            if self.flusher is None or not self.flusher.is_alive():
+                self.flusher = threading.Thread(target=self._loop, name='usage-flush', daemon=True)
+                self.flusher.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(float(common_conf_val('usage_flush_interval', 1)))
+            self.flush()
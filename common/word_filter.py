@@ -1,9 +1,33 @@
 # encoding:utf-8
 
 import ahocorasick
+import redis
+import threading
 import time
 from config import common_conf_val
-from common.redis import RedisSingleton
+from common import log
+
+# writers of word:filter:org:N bump the org field of the version hash and publish the orgid
+WF_VERSION_KEY = "word:filter:version"
+WF_CHANNEL = "word:filter:changed"
+
+_filter_redis = None
+
+def filter_redis():
+    """
+    client bound to the word filter db, so the shared db 0 pool is never switched
+    """
+    global _filter_redis
+    if _filter_redis is None:
+        _filter_redis = redis.Redis(db=int(common_conf_val('word_filter_db', 2)), password=common_conf_val('redis_password', ''))
+    return _filter_redis
+
+def notify_change(orgid):
+    myredis = filter_redis()
+    pipe = myredis.pipeline(transaction=False)
+    pipe.hincrby(WF_VERSION_KEY, "org:{}".format(orgid), 1)
+    pipe.publish(WF_CHANNEL, str(orgid))
+    pipe.execute()
 
 def isnotad(char):
     return not (char.isalpha() or char.isdigit())
@@ -16,44 +40,213 @@ class WordFilter:
             cls._instance = super().__new__(cls)
             cls._instance.words_data = {}
             cls._instance.sync_time = {}
+            cls._instance.versions = {}
+            cls._instance.automata = {}
+            cls._instance.lock = threading.Lock()
+            cls._instance.remote_versions = {}
+            cls._instance.refresher = None
         return cls._instance
 
     def load_words(self, orgid):
-        current=time.time()
+        """
+        cached word list of an org; only the first use of an org reads redis on the caller's thread,
+        later changes are picked up by the background refresher
+        """
         orgkey="org:{}".format(orgid)
-        syncat=self.sync_time.get(orgkey,0)
-        if self.words_data.get(orgkey) is None or current-syncat>60:
-            self.words_data[orgkey]={}
-            wfkey=f"word:filter:{orgkey}"
-            myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
-            myredis.redis.select(2)
-            wfdata=myredis.redis.hgetall(wfkey)
-            myredis.redis.select(0)
-            for wfkey,wfval in wfdata.items():
-                self.words_data[orgkey][wfkey.decode().lower()]=wfval.decode()
-            self.sync_time[orgkey]=current
+        if self.words_data.get(orgkey) is None:
+            self.reload(orgkey)
+        self._ensure_refresher()
         return self.words_data[orgkey],self.sync_time[orgkey]
 
-    def replace_sensitive_words(self, text, words_filt):
+    def reload(self, orgkey):
+        words={}
+        wfdata=filter_redis().hgetall(f"word:filter:{orgkey}")
+        for wfkey,wfval in wfdata.items():
+            words[wfkey.decode().lower()]=wfval.decode()
+        # readers keep the previous dict until the new one is complete; the list and its
+        # version change together so compiled() never pairs a new version with old words
+        with self.lock:
+            changed = words != self.words_data.get(orgkey)
+            reloaded = orgkey in self.words_data
+            self.words_data[orgkey]=words
+            if changed:
+                self.versions[orgkey] = self.versions.get(orgkey, 0) + 1
+            self.sync_time[orgkey]=time.time()
+        if changed and reloaded:
+            log.info("[WORDFILTER] {} reloaded, {} words", orgkey, len(words))
+
+    def _ensure_refresher(self):
+        if self.refresher is not None and self.refresher.is_alive():
+            return
+        with self.lock:
+            if self.refresher is None or not self.refresher.is_alive():
+                self.refresher = threading.Thread(target=self._refresh_loop, name='wordfilter', daemon=True)
+                self.refresher.start()
+
+    def _check_versions(self):
+        versions = {k.decode(): v for k, v in filter_redis().hgetall(WF_VERSION_KEY).items()}
+        for orgkey in list(self.words_data.keys()):
+            version = versions.get(orgkey)
+            if version != self.remote_versions.get(orgkey):
+                if orgkey in self.remote_versions:
+                    self.reload(orgkey)
+                self.remote_versions[orgkey] = version
+
+    def _refresh_loop(self):
+        """
+        reload an org on its pub/sub message; the version hash is compared every
+        word_filter_check_interval seconds in case a message was missed, and all
+        lists are re-read every word_filter_resync seconds for writers that bump nothing
+        """
+        pubsub = None
+        checked = 0
+        resynced = time.time()
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = filter_redis().pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(WF_CHANNEL)
+                message = pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    orgkey = "org:{}".format(message['data'].decode())
+                    if orgkey in self.words_data:
+                        self.reload(orgkey)
+                current = time.time()
+                if current - checked >= float(common_conf_val('word_filter_check_interval', 10)):
+                    checked = current
+                    self._check_versions()
+                if current - resynced >= float(common_conf_val('word_filter_resync', 300)):
+                    resynced = current
+                    for orgkey in list(self.words_data.keys()):
+                        self.reload(orgkey)
+            except Exception as e:
+                log.warn("[WORDFILTER] refresh failed: {}", e)
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+                pubsub = None
+                time.sleep(5)
+
+    def compiled(self, orgid):
+        """
+        merged global + org word dict and its automaton, rebuilt only when either list changed.
+        the result is shared by all threads and must not be modified.
+        """
+        self.load_words(0)
+        orgid = int(orgid)
+        if orgid > 0:
+            self.load_words(orgid)
+        version = (self.versions.get("org:0", 0), self.versions.get("org:{}".format(orgid), 0))
+        entry = self.automata.get(orgid)
+        if entry is not None and entry[0] == version:
+            return entry[1], entry[2]
+        with self.lock:
+            version = (self.versions.get("org:0", 0), self.versions.get("org:{}".format(orgid), 0))
+            entry = self.automata.get(orgid)
+            if entry is not None and entry[0] == version:
+                return entry[1], entry[2]
+            words = dict(self.words_data["org:0"])
+            if orgid > 0:
+                words.update(self.words_data["org:{}".format(orgid)])
+            automaton = self.build_automaton(words)
+            self.automata[orgid] = (version, words, automaton)
+            return words, automaton
+
+    @staticmethod
+    def build_automaton(words_filt):
         if len(words_filt)==0:
-            return text
-        wfkeys = list(words_filt.keys())
+            return None
         automaton = ahocorasick.Automaton()
-        for word in wfkeys:
+        for word in words_filt.keys():
             automaton.add_word(word.lower(), (word,))
         automaton.make_automaton()
+        return automaton
+
+    def filter_text(self, text, orgid):
+        words, automaton = self.compiled(orgid)
+        return self.replace_sensitive_words(text, words, automaton)
+
+    def replace_sensitive_words(self, text, words_filt, automaton=None):
+        if len(words_filt)==0:
+            return text
+        if automaton is None:
+            automaton = self.build_automaton(words_filt)
+        matches = self.find_matches(text, automaton)
+        return self.apply_matches(text, matches, words_filt)
+
+    @staticmethod
+    def find_matches(text, automaton, before=''):
+        """
+        whole-word matches as (start, end) index pairs, overlapping ones skipped
+        :param before: the character preceding text, if text continues an earlier one
+        """
         matches = []
         for edidx, (word,) in automaton.iter(text.lower()):
             stidx = edidx - len(word) + 1
-            if (stidx==0 or isnotad(text[stidx-1])) and (edidx==len(text)-1 or isnotad(text[edidx+1])):
+            if len(matches)>0 and stidx<=matches[-1][1]:
+                continue
+            prev = text[stidx-1] if stidx>0 else before
+            if (prev=='' or isnotad(prev)) and (edidx==len(text)-1 or isnotad(text[edidx+1])):
                 matches.append((stidx, edidx))
+        return matches
+
+    @staticmethod
+    def apply_matches(text, matches, words_filt):
         if len(matches)==0:
             return text
-        offset = 0
-        replaced_text = list(text)
+        parts = []
+        last = 0
         for stidx, edidx in matches:
             filted_word = text[stidx:edidx+1]
-            mapped_word = words_filt.get(filted_word.lower(), filted_word)
-            replaced_text[offset+stidx:offset+edidx+1] = mapped_word
-            offset += len(mapped_word)-len(filted_word)
-        return ''.join(replaced_text)
+            parts.append(text[last:stidx])
+            parts.append(words_filt.get(filted_word.lower(), filted_word))
+            last = edidx+1
+        parts.append(text[last:])
+        return ''.join(parts)
+
+
+class StreamFilter(object):
+    """
+    word filter for streamed replies: text is released as soon as no filter word
+    can still end in it, so only a tail as long as the longest word is held back
+    """
+    def __init__(self, orgid):
+        self.words, self.automaton = WordFilter().compiled(orgid)
+        self.hold = max([len(word) for word in self.words.keys()] or [0])
+        self.pending = ''
+        self.before = ''
+
+    def feed(self, delta):
+        """
+        :return: filtered text that is safe to send now, possibly empty
+        """
+        if not delta:
+            return ''
+        if self.automaton is None:
+            return delta
+        self.pending += delta
+        # a match ending in a later delta starts after cut; one starting before it ends before the last char
+        cut = len(self.pending) - self.hold
+        if cut <= 0:
+            return ''
+        matches = [m for m in WordFilter.find_matches(self.pending, self.automaton, self.before) if m[0] < cut]
+        if len(matches) > 0:
+            cut = max(cut, matches[-1][1]+1)
+        return self._release(cut, matches)
+
+    def finish(self):
+        """
+        :return: the filtered remainder at the end of the stream
+        """
+        if self.automaton is None or len(self.pending) == 0:
+            return ''
+        matches = WordFilter.find_matches(self.pending, self.automaton, self.before)
+        return self._release(len(self.pending), matches)
+
+    def _release(self, cut, matches):
+        released = WordFilter.apply_matches(self.pending[:cut], matches, self.words)
+        self.before = self.pending[cut-1]
+        self.pending = self.pending[cut:]
+        return released
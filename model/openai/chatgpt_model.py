@@ -5,11 +5,23 @@ from config import model_conf, common_conf_val
 from common import const
 from common import log
 from common.redis import RedisSingleton
-from common.word_filter import WordFilter
+from common.word_filter import WordFilter, StreamFilter
+from common.embedding_cache import cached_embeddings
+from common.bot_config import bot_config, abot_config
+from common.graphql import GraphQLClient, gql_string
+from common import side_effects
+from common import metrics
+from common.usage_stats import UsageStats
+from common.team_index import TeamIndex
+from common.dispatch_cache import DispatchCache
+from common.session_store import create_session_store, count_tokens, message_tokens
+from common.context_packer import pack_context, prompt_budget
 from openai import OpenAI
+from openai import AsyncOpenAI
 from openai import AzureOpenAI
 import os
 import time
+import asyncio
 import json
 import re
 import requests
@@ -18,30 +30,33 @@ import random
 import string
 import hashlib
 import openai
-import tiktoken
 import oss2
 import uuid
 from io import BytesIO
 from PIL import Image
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 from langchain_community.chat_models import QianfanChatEndpoint
-from langchain_community.vectorstores import FAISS
+from model.openai.faiss_store import FaissStoreCache
 from langchain_community.callbacks import get_openai_callback
 from langchain_openai import ChatOpenAI
-from langchain_openai import OpenAIEmbeddings
 from langchain_google_genai import ChatGoogleGenerativeAI
 from urllib.parse import urlparse, urlunparse
 from duckduckgo_search import DDGS
 
 oai_key = model_conf(const.OPEN_AI).get('api_key')
 oai_embeddings_model = "text-embedding-ada-002"
-oai_embeddings = OpenAIEmbeddings(openai_api_key=oai_key, model=oai_embeddings_model)
+oai_embeddings = cached_embeddings(oai_key, oai_embeddings_model)
 client = OpenAI(
     base_url=model_conf(const.OPEN_AI).get('api_base'),
     api_key=oai_key,
 )
+aclient = AsyncOpenAI(
+    base_url=model_conf(const.OPEN_AI).get('api_base'),
+    api_key=oai_key,
+)
 azurec = AzureOpenAI(
     azure_endpoint=model_conf(const.OPEN_AI).get('azure_api_base'),
     api_key=model_conf(const.OPEN_AI).get('azure_api_key'),
@@ -53,8 +68,16 @@ qfn_sk = common_conf_val("qianfan_sk", "xxx")
 gmn_key = common_conf_val("google_api_key", "xxx")
 llmgpt = ChatOpenAI(temperature=0, model_name="gpt-4o-mini", openai_api_key=oai_key)
 
-user_session = dict()
-context_tokens = 8192
+user_session = create_session_store()
+# independent vector searches of one request are fanned out on this pool
+search_pool = ThreadPoolExecutor(max_workers=int(common_conf_val('search_workers', 8)), thread_name_prefix='ftsearch')
+context_tokens = int(common_conf_val('context_tokens', 8192))
+metrics.register('sessions', user_session.stats)
+metrics.register('embeddings', oai_embeddings.stats)
+metrics.register('dispatch', lambda: DispatchCache().stats())
+metrics.register('faiss', lambda: FaissStoreCache().stats())
+metrics.register('side_effects', lambda: side_effects.SideEffectQueue().stats())
+metrics.register('usage', lambda: UsageStats().stats())
 md5sum_pattern = r'^[0-9a-f]{32}$'
 faiss_store_root= "/opt/faiss/"
 
@@ -99,24 +122,43 @@ def get_unique_by_key(data, key):
     return unique_list
 
 def num_tokens_from_string(string):
-    encoding = tiktoken.get_encoding("cl100k_base")
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+    return count_tokens(string)
 
 def num_tokens_from_messages(messages):
-    encoding = tiktoken.get_encoding("cl100k_base")
-    tokens_per_message = 4
-    tokens_per_name = -1
     num_tokens = 0
     for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
+        num_tokens += message_tokens(message)
     num_tokens += 3
     return num_tokens
 
+class EmbeddingContext(object):
+    """
+    request-scoped embedding memo, one remote call per distinct text
+    """
+    def __init__(self, embeddings=None):
+        self.embeddings = embeddings or oai_embeddings
+        self.vectors = {}
+
+    def embed_query(self, text, shared=True):
+        """
+        :param shared: False for texts unlikely to repeat (e.g. replies), kept out of the redis tier
+        """
+        vector = self.vectors.get(text)
+        if vector is None:
+            if shared:
+                vector = self.embeddings.embed_query(text)
+            else:
+                vector = self.embeddings.embed_documents([text])[0]
+            self.vectors[text] = vector
+        return vector
+
+    def embed_documents(self, texts):
+        missing = list(dict.fromkeys(text for text in texts if text not in self.vectors))
+        if len(missing) > 0:
+            for text, vector in zip(missing, self.embeddings.embed_documents(missing)):
+                self.vectors[text] = vector
+        return [self.vectors[text] for text in texts]
+
 def remove_url_query(url):
     parsed_url = urlparse(url)
     clean_url = urlunparse((parsed_url.scheme, parsed_url.netloc, parsed_url.path, '', '', ''))
@@ -132,42 +174,52 @@ def is_video_url(url):
     lower_url = url.lower()
     return any(lower_url.endswith(ext) for ext in video_extensions)
 
+def hit_count_mutation(fid, category, url=''):
+    return ('increaseHitCount', f"id:{fid}, category:{gql_string(category)}, url:{gql_string(url)}", '')
+
 def increase_hit_count(fid, category, url=''):
-    gqlurl = 'http://127.0.0.1:5000/graphql'
-    gqlfunc = 'increaseHitCount'
-    headers = { "Content-Type": "application/json", }
-    query = f"mutation {gqlfunc} {{ {gqlfunc}( id:{fid}, category:\"{category}\", url:\"{url}\" ) }}"
-    gqldata = { "query": query, "variables": {}, }
-    try:
-        gqlresp = requests.post(gqlurl, json=gqldata, headers=headers)
-        log.info(f"GQL/{gqlfunc}: #{fid} {gqlresp.status_code} {query}")
-        log.debug(f"GQL/{gqlfunc}: #{fid} {gqlresp.json()}")
-    except Exception as e:
-        log.exception(e)
+    increase_hit_counts([(fid, category, url)])
+
+def increase_hit_counts(hits):
+    """
+    :param hits: list of (fid, category, url), sent in the background
+    """
+    for hit in hits:
+        side_effects.submit('hit_count', list(hit))
 
 def send_query_notification(rid, str1, str2):
-    gqlurl = 'http://127.0.0.1:5000/graphql'
-    gqlfunc = 'notiSfbotNotification'
-    headers = { "Content-Type": "application/json", }
+    send_query_notifications([rid], str1, str2)
+
+def send_query_notifications(rids, str1, str2):
     chatstr = f"{str1}\n\n{str2}"
     content = base64.b64encode(chatstr.encode('utf-8')).decode('utf-8')
-    query = f"mutation {gqlfunc} {{ {gqlfunc}( id:{rid}, content:\"{content}\" ) }}"
-    gqldata = { "query": query, "variables": {}, }
-    try:
-        gqlresp = requests.post(gqlurl, json=gqldata, headers=headers)
-        log.info(f"GQL/{gqlfunc}: #{rid} {gqlresp.status_code} {query}")
-        log.debug(f"GQL/{gqlfunc}: #{rid} {gqlresp.json()}")
-    except Exception as e:
-        log.exception(e)
+    for rid in rids:
+        side_effects.submit('notification', [rid, content])
+
+def flush_batch(payloads, mutations):
+    """
+    :return: the payloads whose mutation was not applied
+    """
+    _, failed = GraphQLClient().execute_batch(mutations)
+    return [payloads[i] for i in failed]
+
+def flush_hit_counts(hits):
+    log.info("GQL/increaseHitCount: {}", [hit[0] for hit in hits])
+    return flush_batch(hits, [hit_count_mutation(*hit) for hit in hits])
+
+def flush_notifications(notifications):
+    log.info("GQL/notiSfbotNotification: {}", [rid for rid, _ in notifications])
+    return flush_batch(notifications, [('notiSfbotNotification', f"id:{rid}, content:\"{content}\"", '') for rid, content in notifications])
+
+def flush_histories(xargs_list):
+    return flush_batch(xargs_list, [('createChatHistory', xargs, 'id tag') for xargs in xargs_list])
+
+side_effects.register('hit_count', flush_hit_counts)
+side_effects.register('notification', flush_notifications)
+side_effects.register('history', flush_histories)
 
 def run_word_filter(text, org_id):
-    wftool = WordFilter()
-    wfdict,_ = wftool.load_words(0)
-    if int(org_id)>0:
-        wfdict_org,_ = wftool.load_words(org_id)
-        wfdict.update(wfdict_org)
-    filted_text = wftool.replace_sensitive_words(text, wfdict)
-    return filted_text
+    return WordFilter().filter_text(text, org_id)
 
 def get_plaid_balance_data(user_id):
     url = f"https://api.sflow.io/plaid/api/balance_data/{user_id}"
@@ -318,7 +370,8 @@ class ChatGPTModel(Model):
                 Session.clear_session(from_user_id)
                 return 'Session is reset.'
 
-            query_embedding = oai_embeddings.embed_query(query)
+            embctx = EmbeddingContext()
+            query_embedding = embctx.embed_query(query)
             orgnum = str(get_org_id(from_org_id))
             botnum = str(get_bot_id(from_chatbot_id))
             myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
@@ -354,6 +407,13 @@ class ChatGPTModel(Model):
                     reply_content+='\n```\n'
                     return reply_content
 
+            # searches that only depend on the query vector run while the rest is resolved
+            query_vector = myredis.vector_bytes(query_embedding)
+            atcqnt_future = search_pool.submit(myredis.multi_search, query_vector, [
+                {'vector_field': "text_vector", 'hybrid_fields': myredis.create_hybrid_field1(orgnum, user_flag, "category", "atc"), 'k': 3},
+                {'vector_field': "text_vector", 'hybrid_fields': myredis.create_hybrid_field(orgnum, "category", "qnt"), 'k': 3},
+            ])
+
             teammode = int(context.get('teammode','0'))
             teambotkeep = int(context.get('teambotkeep','0'))
             # team-bot or assistant-bot
@@ -364,12 +424,13 @@ class ChatGPTModel(Model):
                 user_asst = None
             if user_asst:
                 teambot_key = "sfteam:user:{}:team:{}:bot:{}".format(user_asst,teamid,teambotid)
-                if myredis.redis.exists(teambot_key):
+                teambot_conf = bot_config(teambot_key)
+                if teambot_conf.exists():
                     teammode = 2
-                    teambot_name = myredis.redis.hget(teambot_key, 'name').decode().strip()
-                    teambot_desc = myredis.redis.hget(teambot_key, 'desc').decode().strip()
-                    teambot_prompt = myredis.redis.hget(teambot_key, 'prompt').decode().strip()
-                    teambot_model = myredis.redis.hget(teambot_key, 'model')
+                    teambot_name = teambot_conf.name
+                    teambot_desc = teambot_conf.desc
+                    teambot_prompt = teambot_conf.prompt
+                    teambot_model = teambot_conf.model
                     teambot_nokb = 1
                     if teambot_nokb > 0:
                         fwd = 1
@@ -379,7 +440,7 @@ class ChatGPTModel(Model):
             if teammode == 1:
                 if teambotkeep == 2:
                     teambotkeep = 1
-                    starter = myredis.ft_search(embedded_query=query_embedding,
+                    starter = myredis.ft_search(embedded_query=query_vector,
                                                 vector_field="text_vector",
                                                 hybrid_fields=myredis.create_hybrid_field1(orgnum, user_flag, "category", "starter"),
                                                 k=1)
@@ -388,7 +449,7 @@ class ChatGPTModel(Model):
                 if teambotkeep == 1 and teambotid == 0:
                     teambotkeep = 0
                 if teambotkeep == 0:
-                    newteambot, newteam = self.find_teambot(user_flag, from_org_id, from_chatbot_id, teamid, query)
+                    newteambot, newteam = self.find_teambot(user_flag, from_org_id, from_chatbot_id, teamid, query, query_embedding)
                     if newteambot > 0:
                         teamid = newteam
                         teambotid = newteambot
@@ -397,25 +458,18 @@ class ChatGPTModel(Model):
                             teammode = 0
                 else:
                     if teamid == 0 and teambotid > 0:
-                        teambot_pattern = "sfteam:org:{}:team:*:bot:{}".format(orgnum,teambotid)
-                        keys_matched = myredis.redis.keys(teambot_pattern)
-                        for key in keys_matched:
-                            teambot_key=key.decode()
-                            teamid=int(teambot_key.split(':')[4])
+                        teamid = TeamIndex.team_of_bot(orgnum, teambotid)
 
             if teammode == 1:
                 teambot_key = "sfteam:org:{}:team:{}:bot:{}".format(orgnum,teamid,teambotid)
                 log.info("[CHATGPT] key={} query={}".format(teambot_key,query))
-                if myredis.redis.exists(teambot_key):
-                    teambot_name = myredis.redis.hget(teambot_key, 'name').decode().strip()
-                    teambot_desc = myredis.redis.hget(teambot_key, 'desc').decode().strip()
-                    teambot_prompt = myredis.redis.hget(teambot_key, 'prompt').decode().strip()
-                    teambot_model = myredis.redis.hget(teambot_key, 'model')
-                    teambot_nokb = myredis.redis.hget(teambot_key, 'nokb')
-                    if teambot_nokb is not None:
-                        teambot_nokb = int(teambot_nokb.decode().strip())
-                    else:
-                        teambot_nokb = 0
+                teambot_conf = bot_config(teambot_key)
+                if teambot_conf.exists():
+                    teambot_name = teambot_conf.name
+                    teambot_desc = teambot_conf.desc
+                    teambot_prompt = teambot_conf.prompt
+                    teambot_model = teambot_conf.model
+                    teambot_nokb = teambot_conf.nokb
                     if teambot_nokb > 0:
                         fwd = 1
                 else:
@@ -434,40 +488,42 @@ class ChatGPTModel(Model):
                 character_id = f"x{teambotid}"
                 character_desc = teambot_instruction
                 if sfmodel is None and teambot_model is not None:
-                    sfmodel = teambot_model.decode().strip()
+                    sfmodel = teambot_model
                 log.info("[CHATGPT] {} character id={} desc={}".format('asstbot' if user_asst else 'teambot',character_id,character_desc))
             else:
                 sfbot_key = "sfbot:org:{}:bot:{}".format(orgnum,botnum)
-                sfbot_model = myredis.redis.hget(sfbot_key, 'model')
-                baidu_key = myredis.redis.hget(sfbot_key, 'baidu_key')
-                google_key = myredis.redis.hget(sfbot_key, 'google_key')
+                sfbot_conf = bot_config(sfbot_key)
+                sfbot_model = sfbot_conf.model
+                baidu_key = sfbot_conf.baidu_key
+                google_key = sfbot_conf.google_key
                 if sfmodel is None and sfbot_model is not None:
-                    sfmodel = sfbot_model.decode().strip()
+                    sfmodel = sfbot_model
                 if baidu_key is not None:
-                    baidu_key = baidu_key.decode().strip()
                     if isinstance(baidu_key, str) and len(baidu_key) > 0:
                         llm_provider = 'baidu'
                         llm_credential = baidu_key
                 if google_key is not None:
-                    google_key = google_key.decode().strip()
                     if isinstance(google_key, str) and len(google_key) > 0:
                         llm_provider = 'google'
                         llm_credential = google_key
 
             commands = []
-            atcs = myredis.ft_search(embedded_query=query_embedding,
-                                     vector_field="text_vector",
-                                     hybrid_fields=myredis.create_hybrid_field1(orgnum, user_flag, "category", "atc"),
-                                     k=3)
+            atcs, qnts = atcqnt_future.result()
             if len(atcs) > 0:
+                atcrows = myredis.hydrate(atcs, ['id'])
                 for i, atc in enumerate(atcs):
                     if float(atc.vector_score) > 0.15:
                         break
-                    cid = myredis.redis.hget(atc.id, 'id').decode()
+                    cid = atcrows[i]['id'].decode()
                     csf = 1.0 - float(atc.vector_score)
                     commands.append({'id':cid,'category':"actionTransformer",'score':csf})
 
-            new_query, hitdocs, refurls, similarity, use_faiss = Session.build_session_query(query, from_user_id, from_org_id, from_chatbot_id, user_flag, character_desc, character_id, user_asst, website, email, fwd, ctx)
+            target_model = sfmodel or model_conf(const.OPEN_AI).get("model") or "gpt-4o-mini"
+            if llm_provider == 'baidu':
+                target_model = "ERNIE-Lite-8K"
+            elif llm_provider == 'google':
+                target_model = "gemini-pro"
+            new_query, hitdocs, refurls, similarity, use_faiss = Session.build_session_query(query, from_user_id, from_org_id, from_chatbot_id, user_flag, character_desc, character_id, user_asst, website, email, fwd, ctx, embctx, target_model)
             if new_query is None:
                 return 'Sorry, I have no ideas about what you said.'
 
@@ -487,28 +543,36 @@ class ChatGPTModel(Model):
             #     return self.reply_text_stream(query, new_query, from_user_id)
 
             reply_content, logid = self.reply_text(new_query, query, llm_provider, llm_credential, sfmodel, from_user_id, from_org_id, from_chatbot_id, sfuserid, similarity, temperature, use_faiss, 0)
-            reply_embedding = oai_embeddings.embed_query(reply_content)
-            docs = myredis.ft_search(embedded_query=reply_embedding,
-                                     vector_field="text_vector",
-                                     hybrid_fields=myredis.create_hybrid_field2(orgnum, botnum, user_flag, "category", "kb"),
-                                     k=1)
+            reply_embedding = embctx.embed_query(reply_content, shared=False)
+            docs_future = search_pool.submit(myredis.ft_search, embedded_query=reply_embedding,
+                                             vector_field="text_vector",
+                                             hybrid_fields=myredis.create_hybrid_field2(orgnum, botnum, user_flag, "category", "kb"),
+                                             k=1)
+            resources_future = None
+            insert_future = None
+            if nres > 0:
+                resources_future = search_pool.submit(Session.get_resources, reply_content, from_user_id, from_org_id, embctx)
+                insert_future = search_pool.submit(Session.insert_resource_to_reply, reply_content, from_user_id, from_org_id, embctx)
+            docs = docs_future.result()
             score = 0.0
             if len(docs) > 0:
                 score = 1.0 - float(docs[0].vector_score)
 
-            qnts = myredis.ft_search(embedded_query=query_embedding, vector_field="text_vector", hybrid_fields=myredis.create_hybrid_field(orgnum, "category", "qnt"), k=3)
             if len(qnts) > 0:
+                qntrows = myredis.hydrate(qnts, ['id'])
+                rids = []
                 for i, qnt in enumerate(qnts):
                     log.info(f"{i}) {qnt.id} {qnt.orgid} {qnt.category} {qnt.vector_score}")
                     if float(qnt.vector_score) > 0.2:
                         break
-                    rid = myredis.redis.hget(qnt.id, 'id').decode()
-                    send_query_notification(rid, query, reply_content)
+                    rids.append(qntrows[i]['id'].decode())
+                if len(rids) > 0:
+                    send_query_notifications(rids, query, reply_content)
 
             resources = []
             if nres > 0:
-                resources = Session.get_resources(reply_content, from_user_id, from_org_id)
-                reply_content = Session.insert_resource_to_reply(reply_content, from_user_id, from_org_id)
+                resources = resources_future.result()
+                reply_content = insert_future.result()
             reply_content = run_word_filter(reply_content, get_org_id(from_org_id))
             reply_content+='\n```sf-json\n'
             reply_content+=json.dumps({'docs':hitdocs,'pages':refurls,'resources':resources,'commands':commands,'score':score,'logid':logid,'teammode':teammode,'teamid':teamid,'teambotid':teambotid})
@@ -525,27 +589,20 @@ class ChatGPTModel(Model):
             reply_content+='\n```\n'
             return reply_content
 
-    def find_teambot(self, user_flag, org_id, chatbot_id, team_id, query):
-        myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
+    def find_teambot(self, user_flag, org_id, chatbot_id, team_id, query, query_embedding=None):
         orgnum = get_org_id(org_id)
         botnum = get_bot_id(chatbot_id)
         team_info = '# Team Information\n'
-        team_keys = []
-        team_pattern = "sfteam:org:{}:team:*:data".format(orgnum)
-        keys_matched = myredis.redis.keys(team_pattern)
-        for key in keys_matched:
-            team_keys.append(key.decode())
-        if team_id > 0:
-            team_key = "sfteam:org:{}:team:{}:data".format(orgnum,team_id)
-            if team_key in team_keys:
-                team_keys.clear()
-                team_keys.append(team_key)
-        for key in team_keys:
-            team_desc = myredis.redis.hget(key, 'team_desc').decode()
-            team_publ = 1
-            fpub = myredis.redis.hget(key, 'public')
-            if fpub is not None:
-                team_publ = int(fpub.decode())
+        teams = TeamIndex.teams(orgnum)
+        if team_id > 0 and team_id in teams:
+            teams = [team_id]
+        for team in teams:
+            team_conf = bot_config("sfteam:org:{}:team:{}:data".format(orgnum,team))
+            if not team_conf.exists():
+                TeamIndex.repair_team(orgnum, team)
+                continue
+            team_desc = team_conf.team_desc
+            team_publ = team_conf.public
             if team_publ == 1:
                 team_info += team_desc+'\n'
             else:
@@ -554,6 +611,11 @@ class ChatGPTModel(Model):
         if len(team_info) < 20:
             log.info("[CHATGPT] find_teambot: No available team {}/{}".format(org_id,user_flag))
             return 0, 0
+        team_hash = calculate_md5(team_info)
+        if query_embedding is not None:
+            cached = DispatchCache().lookup(orgnum, team_hash, query_embedding)
+            if cached is not None:
+                return cached
         sys_msg = (
             "You are a contact-center manager, and you try to dispatch the user query to the most suitable team/agent.\n"
             "You only provide clear, concise, factual answers to queries, and do not try to make up an answer.\n"
@@ -590,7 +652,10 @@ class ChatGPTModel(Model):
             reply_usage = response.usage
             log.info("[CHATGPT] find_teambot: result={} usage={}".format(reply_content,reply_usage))
             dispatch = json.loads(reply_content)
-            return int(dispatch['agent_id']), int(dispatch['team_id'])
+            agent_id, team_id = int(dispatch['agent_id']), int(dispatch['team_id'])
+            if query_embedding is not None:
+                DispatchCache().store(orgnum, team_hash, query_embedding, agent_id, team_id)
+            return agent_id, team_id
         except Exception as e:
             log.exception(e)
             return 0, 0
@@ -631,6 +696,7 @@ class ChatGPTModel(Model):
             #from_org_id, from_chatbot_id, user_flag, character_desc, character_id, None, None, None, fwd, ctx)
             new_query = [{ "role": "system", "content": character_desc }, { "role": "user", "content": query }]
             mtx = ""
+            sfilter = StreamFilter(get_org_id(from_org_id))
             response = client.chat.completions.create(
                 messages=new_query,
                 model=sfmodel,
@@ -641,6 +707,7 @@ class ChatGPTModel(Model):
             )
             for chunk in response:
                 if len(chunk.choices)>0:
+                    finished = chunk.choices[0].finish_reason is not None
                     chunk.id = reqid
                     del chunk.object
                     del chunk.system_fingerprint
@@ -659,6 +726,9 @@ class ChatGPTModel(Model):
                         del chunk.choices[0].delta.tool_calls
                     if isinstance(chunk.choices[0].delta.content, str):
                         mtx += chunk.choices[0].delta.content
+                        chunk.choices[0].delta.content = sfilter.feed(chunk.choices[0].delta.content)
+                    if finished:
+                        chunk.choices[0].delta.content = (chunk.choices[0].delta.content or '') + sfilter.finish()
                     yield 'data: '+chunk.model_dump_json()+'\n\n'
                 else:
                     if chunk.usage:
@@ -818,20 +888,32 @@ class ChatGPTModel(Model):
                 fwd = 0
                 ctx = 0
 
-            new_query, hitdocs, refurls, similarity, use_faiss = Session.build_session_query(query, from_user_id, from_org_id, from_chatbot_id, user_flag, character_desc, character_id, user_asst, website, email, fwd, ctx)
+            orgnum = str(get_org_id(from_org_id))
+            botnum = str(get_bot_id(from_chatbot_id))
+            sfbot_key = "sfbot:org:{}:bot:{}".format(orgnum,botnum)
+            sfbot_model = (await abot_config(sfbot_key)).model
+            if sfmodel is None and sfbot_model is not None:
+                sfmodel = sfbot_model
+            target_model = sfmodel or model_conf(const.OPEN_AI).get("model") or "gpt-4o-mini"
+
+            # retrieval and history writes are blocking, keep them off the event loop
+            embctx = EmbeddingContext()
+            new_query, hitdocs, refurls, similarity, use_faiss = await asyncio.to_thread(Session.build_session_query, query, from_user_id, from_org_id, from_chatbot_id, user_flag, character_desc, character_id, user_asst, website, email, fwd, ctx, embctx, target_model)
             if new_query is None:
                 yield True,'Sorry, I have no ideas about what you said.'
+                return
 
             log.info("[CHATGPT] session query={}".format(new_query))
             if new_query[-1]['role'] == 'assistant':
                 reply_message = new_query.pop()
                 reply_content = reply_message['content']
-                logid = Session.save_session(query, reply_content, from_user_id, from_org_id, from_chatbot_id, sfuserid, 'auto', 0, 0, 0, similarity, use_faiss)
-                reply_content = run_word_filter(reply_content, get_org_id(from_org_id))
+                logid = await asyncio.to_thread(Session.save_session, query, reply_content, from_user_id, from_org_id, from_chatbot_id, sfuserid, 'auto', 0, 0, 0, similarity, use_faiss)
+                reply_content = await asyncio.to_thread(run_word_filter, reply_content, get_org_id(from_org_id))
                 reply_content+='\n```sf-json\n'
                 reply_content+=json.dumps({'logid':logid})
                 reply_content+='\n```\n'
                 yield True,reply_content
+                return
 
             try:
                 temperature = float(temperature)
@@ -840,16 +922,8 @@ class ChatGPTModel(Model):
             except ValueError:
                 temperature = model_conf(const.OPEN_AI).get("temperature", 0.75)
 
-            orgnum = str(get_org_id(from_org_id))
-            botnum = str(get_bot_id(from_chatbot_id))
-            myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
-            sfbot_key = "sfbot:org:{}:bot:{}".format(orgnum,botnum)
-            sfbot_model = myredis.redis.hget(sfbot_key, 'model')
-            if sfmodel is None and sfbot_model is not None:
-                sfmodel = sfbot_model.decode().strip()
-
-            res = client.chat.completions.create(
-                model=sfmodel or model_conf(const.OPEN_AI).get("model") or "gpt-4o-mini",
+            res = await aclient.chat.completions.create(
+                model=target_model,
                 messages=new_query,
                 temperature=temperature,  # 熵值，在[0,1]之间，越大表示选取的候选词越随机，回复越具有不确定性，建议和top_p参数二选一使用，创意性任务越大越好，精确性任务越小越好
                 #max_tokens=context_tokens,
@@ -860,7 +934,13 @@ class ChatGPTModel(Model):
                 stream_options={"include_usage":True},
             )
             full_response = ""
-            for chunk in res:
+            filtered_response = ""
+            sfilter = await asyncio.to_thread(StreamFilter, get_org_id(from_org_id))
+            model_name = target_model
+            used_tokens = 0
+            prompt_tokens = 0
+            completion_tokens = 0
+            async for chunk in res:
                 log.debug(chunk)
                 if chunk.usage:
                     log.info("[CHATGPT|stream][{}] usage={}", chunk.model, chunk.usage)
@@ -868,24 +948,26 @@ class ChatGPTModel(Model):
                     used_tokens = chunk.usage.total_tokens
                     prompt_tokens = chunk.usage.prompt_tokens
                     completion_tokens = chunk.usage.completion_tokens
-                if chunk.choices[0].finish_reason=="stop":
-                    break
+                # with include_usage the usage arrives in a last chunk without choices
+                if len(chunk.choices) == 0 or chunk.choices[0].finish_reason is not None:
+                    continue
                 chunk_message = chunk.choices[0].delta.content
                 if(chunk_message):
                     full_response+=chunk_message
-                yield False,full_response
+                    filtered_response+=sfilter.feed(chunk_message)
+                yield False,filtered_response
             """
             prompt_tokens = num_tokens_from_messages(new_query)
             completion_tokens = num_tokens_from_string(full_response)
             used_tokens = prompt_tokens + completion_tokens
             """
-            logid = Session.save_session(query, full_response, from_user_id, from_org_id, from_chatbot_id, sfuserid, model_name, used_tokens, prompt_tokens, completion_tokens, similarity, use_faiss)
+            logid = await asyncio.to_thread(Session.save_session, query, full_response, from_user_id, from_org_id, from_chatbot_id, sfuserid, model_name, used_tokens, prompt_tokens, completion_tokens, similarity, use_faiss)
 
             resources = []
             if nres > 0:
-                resources = Session.get_resources(full_response, from_user_id, from_org_id)
+                resources = await asyncio.to_thread(Session.get_resources, full_response, from_user_id, from_org_id, embctx)
 
-            full_response = run_word_filter(full_response, get_org_id(from_org_id))
+            full_response = filtered_response + sfilter.finish()
             full_response+='\n```sf-json\n'
             full_response+=json.dumps({'docs':hitdocs,'pages':refurls,'resources':resources,'logid':logid})
             full_response+='\n```\n'
@@ -896,9 +978,10 @@ class ChatGPTModel(Model):
             # rate limit exception
             log.warn(e)
             if retry_count < 1:
-                time.sleep(5)
+                await asyncio.sleep(5)
                 log.warn("[CHATGPT] RateLimit exceed, retry {} attempts".format(retry_count+1))
-                yield True, self.reply_text_stream(query, context, retry_count+1)
+                async for final, response in self.reply_text_stream(query, context, retry_count+1):
+                    yield final, response
             else:
                 yield True, "You're asking too quickly, please take a break before asking me again."
         except openai.APIConnectionError as e:
@@ -972,7 +1055,7 @@ class ChatGPTModel(Model):
 
 class Session(object):
     @staticmethod
-    def build_session_query(query, user_id, org_id, chatbot_id='bot:0', user_flag='external', character_desc=None, character_id=None, user_uuid=None, website=None, email=None, fwd=0, ctx=0):
+    def build_session_query(query, user_id, org_id, chatbot_id='bot:0', user_flag='external', character_desc=None, character_id=None, user_uuid=None, website=None, email=None, fwd=0, ctx=0, embctx=None, model=None):
         '''
         build query with conversation history
         e.g.  [
@@ -983,17 +1066,20 @@ class Session(object):
         ]
         :param query: query content
         :param user_id: from user id
+        :param embctx: request-scoped EmbeddingContext shared with the caller
+        :param model: target model, sizes the prompt budget
         :return: query content with conversaction
         '''
+        if embctx is None:
+            embctx = EmbeddingContext()
         config_prompt = common_conf_val("input_prompt", "")
         max_history_num = model_conf(const.OPEN_AI).get('max_history_num', None)
 
-        if user_id not in user_session:
-            user_session[user_id] = []
         session = user_session.get(user_id)
         query_tokens = num_tokens_from_string(query)
         if query_tokens >= context_tokens/2:
             Session.clear_session(user_id)
+            session = []
 
         faiss_id = user_id
         if isinstance(website, str) and website != 'undef' and len(website) > 0:
@@ -1007,7 +1093,7 @@ class Session(object):
             log.info("[FAISS] try to load local store {}".format(faiss_id))
         if re.match(md5sum_pattern, faiss_id) and os.path.exists(f"{faiss_store_root}{faiss_id}"):
             faiss_store_path = f"{faiss_store_root}{faiss_id}"
-            dbx = FAISS.load_local(faiss_store_path, oai_embeddings)
+            dbx = FaissStoreCache().load(faiss_store_path, oai_embeddings)
             log.info("[FAISS] local store loaded")
             similarity = 0.0
             docs = dbx.similarity_search_with_score(query, k=3)
@@ -1028,20 +1114,20 @@ class Session(object):
             # system_prompt += '\nIf the question is not related to the context, politely respond that you are tuned to only answer questions that are related to the context.'
             system_prompt += '\nIf you are unclear about the question, politely respond that you need a clearer and more detailed description.'
             system_prompt += f"\n{config_prompt}\n```"
+            chunks = []
             for doc, score in docs:
                 log.info("[FAISS] {} {}".format(score, json.dumps(doc.metadata)))
                 '''
                 if score < 0.6:
                     break
                 '''
-                system_prompt += '\n' + doc.page_content
-            system_prompt += '\n```\n'
+                chunks.append(doc.page_content)
+            system_prompt, _ = pack_context(system_prompt, chunks, [], query, prompt_budget(model, context_tokens), fenced=True)
             log.info("[FAISS] prompt={}".format(system_prompt))
             system_item = {'role': 'system', 'content': system_prompt}
             user_item = {'role': 'user', 'content': query}
-            session.clear()
-            session.append(system_item)
-            session.append(user_item)
+            session = [system_item, user_item]
+            user_session.put(user_id, session)
             return session, [], [], similarity, True
 
         file_chat = False
@@ -1061,20 +1147,27 @@ class Session(object):
         refurls = []
         hitdocs = []
         qna_output = None
-        myquery = oai_embeddings.embed_query(query)
+        myquery = embctx.embed_query(query)
         myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
-        qnas = myredis.ft_search(embedded_query=myquery, vector_field="title_vector", hybrid_fields=myredis.create_hybrid_field(qnaorg, "category", "qa"))
-        if file_chat:
-            qnas = []
+        # qa and kb searches share the query vector, so they go out in one pipeline
+        search_specs = [{'vector_field': "text_vector", 'hybrid_fields': myredis.create_hybrid_field2(str(orgnum), botnum, user_flag, "category", "ka" if file_chat else "kb")}]
+        if not file_chat:
+            search_specs.append({'vector_field': "title_vector", 'hybrid_fields': myredis.create_hybrid_field(qnaorg, "category", "qa")})
+        search_results = myredis.multi_search(myquery, search_specs)
+        docs = search_results[0]
+        qnas = []
+        if not file_chat:
+            qnas = search_results[1]
         if len(qnas) > 0 and float(qnas[0].vector_score) < 0.15:
             qna = qnas[0]
             log.info(f"Q/A: {qna.id} {qna.orgid} {qna.category} {qna.vector_score}")
             try:
-                qnatext = myredis.redis.hget(qna.id, 'text').decode()
+                qnarow = myredis.hydrate([qna], ['text', 'id'])[0]
+                qnatext = qnarow['text'].decode()
                 answers = json.loads(qnatext)
                 if len(answers)>0:
                     qna_output = random.choice(answers)
-                    fid = myredis.redis.hget(qna.id, 'id').decode()
+                    fid = qnarow['id'].decode()
                     increase_hit_count(fid, 'qa', '')
             except json.JSONDecodeError as e:
                 pass
@@ -1084,8 +1177,9 @@ class Session(object):
         log.info("[RDSFT] org={} {} {}".format(org_id, orgnum, qnaorg))
         if user_uuid:
             fc_key = "sftool:org:{}:action:{}".format(orgnum,39)
-            if myredis.redis.exists(fc_key):
-                fc_json = myredis.redis.hget(fc_key, 'fcjson').decode()
+            fc_conf = bot_config(fc_key)
+            if fc_conf.exists():
+                fc_json = fc_conf.get('fcjson')
                 fc_tools = []
                 fc_tools.append({"type":"function","function":json.loads(fc_json)})
                 fc_funcs = { "get_latest_news": get_latest_news, }
@@ -1112,9 +1206,6 @@ class Session(object):
                     #query += f"\n\n```\n{fc_data}\n```\n"
 
         similarity = 0.0
-        docs = myredis.ft_search(embedded_query=myquery,
-                                 vector_field="text_vector",
-                                 hybrid_fields=myredis.create_hybrid_field2(str(orgnum), botnum, user_flag, "category", "ka" if file_chat else "kb"))
 
         system_prompt = 'You are a helpful AI customer support agent. Use the following pieces of context to answer the customer inquiry.'
         if file_chat:
@@ -1123,9 +1214,10 @@ class Session(object):
         orgnum = str(get_org_id(org_id))
         botnum = str(get_bot_id(chatbot_id))
         sfbot_key = "sfbot:org:{}:bot:{}".format(orgnum,botnum)
-        sfbot_threshold = myredis.redis.hget(sfbot_key, 'threshold')
+        sfbot_conf = bot_config(sfbot_key)
+        sfbot_threshold = sfbot_conf.threshold
         if sfbot_threshold is not None:
-            sfbot_threshold = 1.0-int(sfbot_threshold.decode())/100
+            sfbot_threshold = 1.0-sfbot_threshold/100
         else:
             sfbot_threshold = float(common_conf_val('similarity_threshold', 0.75))
         if len(docs) > 0:
@@ -1133,9 +1225,8 @@ class Session(object):
             if similarity < sfbot_threshold:
                 docs = []
 
-        sfbot_char_desc = myredis.redis.hget(sfbot_key, 'character_desc')
+        sfbot_char_desc = sfbot_conf.character_desc
         if sfbot_char_desc is not None:
-            sfbot_char_desc = sfbot_char_desc.decode()
             if len(sfbot_char_desc) > 0:
                 system_prompt = sfbot_char_desc
         if isinstance(character_desc, str) and character_desc != 'undef' and len(character_desc) > 0:
@@ -1143,16 +1234,7 @@ class Session(object):
 
         if fwd > 0:
             log.info("[CHATGPT] prompt(onlyfwd)={}".format(system_prompt))
-            if len(session) > 0 and session[0]['role'] == 'system':
-                session.pop(0)
-            if len(session) > ctx*2:
-                del session[:len(session)-ctx*2]
-            system_item = {'role': 'system', 'content': system_prompt}
-            user_item = {'role': 'user', 'content': query}
-            session.insert(0, system_item)
-            session.append(user_item)
-            while len(session) > 3 and num_tokens_from_messages(session) > context_tokens:
-                del session[1:3]
+            session = Session.compose_session(user_id, session, system_prompt, query, ctx, model=model)
             return session, [], [], similarity, False
 
         if isinstance(character_id, str) and character_id.startswith('x'):
@@ -1164,53 +1246,50 @@ class Session(object):
 
         if len(docs) == 0 and qna_output is None:
             log.info("[CHATGPT] prompt(nodoc)={}".format(system_prompt))
-            if len(session) > 0 and session[0]['role'] == 'system':
-                session.pop(0)
-            if len(session) > ctx*2:
-                del session[:len(session)-ctx*2]
-            system_item = {'role': 'system', 'content': system_prompt}
-            user_item = {'role': 'user', 'content': query}
-            session.insert(0, system_item)
-            session.append(user_item)
-            while len(session) > 3 and num_tokens_from_messages(session) > context_tokens:
-                del session[1:3]
+            session = Session.compose_session(user_id, session, system_prompt, query, ctx, model=model)
             return session, [], [], similarity, False
 
         system_prompt += f"\n{config_prompt}\n```"
+        # the QnA answer goes first, KB docs follow in score order
+        chunks = []
         if qna_output is not None:
-            system_prompt += '\n' + qna_output
+            chunks.append(qna_output)
+        docrows = myredis.hydrate(docs, ['text', 'source', 'dkey', 'filename', 'refkey'])
+        urldocs = []
         for i, doc in enumerate(docs):
             log.info(f"{i}) {doc.id} {doc.orgid} {doc.category} {doc.vector_score}")
+            docrow = docrows[i]
             if float(doc.vector_score) < sfbot_threshold:
-                system_prompt += '\n' + myredis.redis.hget(doc.id, 'text').decode()
+                chunks.append(docrow['text'].decode())
             if float(doc.vector_score) < 0.15:
                 urlhit = ''
-                docurl = myredis.redis.hget(doc.id, 'source')
+                docurl = docrow['source']
                 if docurl is not None:
                     urlhit = docurl.decode()
-                dockey = myredis.redis.hget(doc.id, 'dkey')
+                dockey = docrow['dkey']
                 if dockey is not None:
                     dockey = dockey.decode()
                     dockeyparts = dockey.split(":")
                     fct = dockeyparts[1]
                     fid = dockeyparts[2]
                     if fct == 'file':
-                        dfname = myredis.redis.hget(doc.id, 'filename')
+                        dfname = docrow['filename']
                         if dfname is not None:
                             dfname = dfname.decode()
                         hitdocs.append({'id':fid,'category':fct,'url':urlhit,'filename':dfname,'key':f"{fid};{urlhit}"})
             if float(doc.vector_score) < 0.2:
-                docurl = myredis.redis.hget(doc.id, 'source')
-                if docurl is None:
-                    continue
-                urlkey = myredis.redis.hget(doc.id, 'refkey')
-                if urlkey is None:
+                if docrow['source'] is None or docrow['refkey'] is None:
                     continue
+                urldocs.append((i, doc, docrow['source'].decode(), docrow['refkey'].decode()))
+        if len(urldocs) > 0:
+            pipe = myredis.redis.pipeline(transaction=False)
+            for i, doc, docurl, urlkey in urldocs:
+                pipe.lindex(urlkey, 0)
+            urlmetas = pipe.execute()
+            for (i, doc, docurl, urlkey), urlmeta in zip(urldocs, urlmetas):
                 urltitle = None
                 try:
-                    docurl = docurl.decode()
-                    urlkey = urlkey.decode()
-                    urlmeta = json.loads(myredis.redis.lindex(urlkey, 0).decode())
+                    urlmeta = json.loads(urlmeta.decode())
                     urltitle = urlmeta['title']
                 except json.JSONDecodeError as e:
                     log.info("Error decoding JSON: {} {}".format(urlkey, str(e)))
@@ -1218,34 +1297,44 @@ class Session(object):
                     log.info("Error URL: {} {}".format(urlkey, str(e)))
                 log.info(f"{i}) {doc.id} URL={docurl} Title={urltitle}")
                 refurls.append({'url': docurl, 'title': urltitle})
-        system_prompt += '\n```\n'
-        log.info("[CHATGPT] prompt={}".format(system_prompt))
         refurls = get_unique_by_key(refurls, 'url')
         hitdocs = get_unique_by_key(hitdocs, 'key')
         hitdocs = [{k: v for k, v in d.items() if k != 'key'} for d in hitdocs]
         if file_chat:
             hitdocs = []
-        for doc in hitdocs:
-            increase_hit_count(doc['id'], doc['category'], doc['url'])
+        if len(hitdocs) > 0:
+            increase_hit_counts([(doc['id'], doc['category'], doc['url']) for doc in hitdocs])
+        session = Session.compose_session(user_id, session, system_prompt, query, ctx, chunks, model, fenced=True)
+        log.info("[CHATGPT] prompt={}".format(session[0]['content']))
+        return session, hitdocs, refurls, similarity, False
+
+    @staticmethod
+    def compose_session(user_id, session, system_prompt, query, ctx=0, chunks=None, model=None, fenced=None):
+        '''
+        replace the system prompt, keep the last ctx turns, pack context chunks and
+        history into the prompt budget of the model, append the query and store the result
+        '''
         if len(session) > 0 and session[0]['role'] == 'system':
             session.pop(0)
         if len(session) > ctx*2:
             del session[:len(session)-ctx*2]
+        system_prompt, history = pack_context(system_prompt, chunks or [], session, query, prompt_budget(model, context_tokens), fenced)
         system_item = {'role': 'system', 'content': system_prompt}
         user_item = {'role': 'user', 'content': query}
-        session.insert(0, system_item)
-        session.append(user_item)
-        while len(session) > 3 and num_tokens_from_messages(session) > context_tokens:
-            del session[1:3]
-        return session, hitdocs, refurls, similarity, False
+        dropped = len(history) < len(session)
+        session = [system_item] + history + [user_item]
+        # the stored log is only rewritten when the budget dropped turns, otherwise the query is appended
+        if dropped:
+            user_session.put(user_id, session)
+        else:
+            user_session.put(user_id, session, appended=[user_item])
+        return session
 
     @staticmethod
     def save_session(query, answer, user_id, org_id, chatbot_id, sfuserid="undef", model_name="auto", used_tokens=0, prompt_tokens=0, completion_tokens=0, similarity=0.0, use_faiss=False):
-        session = user_session.get(user_id)
-        if session:
-            # append conversation
-            gpt_item = {'role': 'assistant', 'content': answer}
-            session.append(gpt_item)
+        # append conversation
+        gpt_item = {'role': 'assistant', 'content': answer}
+        user_session.append(user_id, gpt_item)
         """
         max_tokens = model_conf(const.OPEN_AI).get('conversation_max_tokens')
         if not max_tokens or max_tokens > context_tokens:
@@ -1260,58 +1349,55 @@ class Session(object):
         orgnum = str(get_org_id(org_id))
         botnum = str(get_bot_id(chatbot_id))
         if used_tokens > 0:
-            myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
             sfbot_key = "sfbot:org:{}:bot:{}".format(orgnum,botnum)
-            momkey = 'stat_'+datetime.now().strftime("%Y%m")
-            momqty = myredis.redis.hget(sfbot_key, momkey)
-            if momqty is None:
-                myredis.redis.hset(sfbot_key, momkey, 1)
-            else:
-                momqty = int(momqty.decode())
-                myredis.redis.hset(sfbot_key, momkey, momqty+1)
+            UsageStats().record(sfbot_key, model_name, prompt_tokens, completion_tokens, used_tokens)
 
         if botnum == '0':
             return None
 
-        gqlurl = 'http://127.0.0.1:5000/graphql'
         gqlfunc = 'createChatHistory'
-        headers = { "Content-Type": "application/json", }
         question = base64.b64encode(query.encode('utf-8')).decode('utf-8')
         answer = base64.b64encode(answer.encode('utf-8')).decode('utf-8')
         sfuidkv = ''
         if isinstance(sfuserid, str) and sfuserid != 'undef' and len(sfuserid) > 0:
             sfuidkv = f"userId:\"{sfuserid}\","
-        xquery = f"""mutation {gqlfunc} {{ {gqlfunc}( chatHistory:{{ tag:"{user_id}",organizationId:{orgnum},sfbotId:{botnum},{sfuidkv}question:"{question}",answer:"{answer}",similarity:{similarity},model:"{model_name}",promptTokens:{prompt_tokens},completionTokens:{completion_tokens},totalTokens:{used_tokens}}}){{ id tag }} }}"""
-        gqldata = { "query": xquery, "variables": {}, }
-        try:
-            gqlresp = requests.post(gqlurl, json=gqldata, headers=headers)
-            log.info("[HISTORY] response: {} {}".format(gqlresp.status_code, gqlresp.text.strip()))
-            if gqlresp.status_code != 200:
-                return None
-            chatlog = json.loads(gqlresp.text)
-            return chatlog['data']['createChatHistory']['id']
-        except Exception as e:
-            log.exception(e)
+        logidkv = ''
+        logid = None
+        if common_conf_val('history_async', False):
+            # the id is allocated here so the reply does not wait for the write
+            logid = str(uuid.uuid4())
+            logidkv = f"logId:\"{logid}\","
+        xargs = f"""chatHistory:{{ tag:"{user_id}",organizationId:{orgnum},sfbotId:{botnum},{sfuidkv}{logidkv}question:"{question}",answer:"{answer}",similarity:{similarity},model:"{model_name}",promptTokens:{prompt_tokens},completionTokens:{completion_tokens},totalTokens:{used_tokens}}}"""
+        if logid is not None:
+            side_effects.submit('history', xargs)
+            return logid
+        chatlog = GraphQLClient().mutate(gqlfunc, xargs, 'id tag')
+        log.info("[HISTORY] response: {}".format(chatlog))
+        if chatlog is None:
             return None
+        return chatlog['id']
 
     @staticmethod
     def clear_session(user_id):
-        user_session[user_id] = []
+        user_session.clear(user_id)
 
     @staticmethod
-    def get_resources(query, user_id, org_id):
+    def get_resources(query, user_id, org_id, embctx=None):
+        if embctx is None:
+            embctx = EmbeddingContext()
         orgnum = get_org_id(org_id)
         resorg = "(0|{})".format(orgnum)
-        myquery = oai_embeddings.embed_query(query)
+        myquery = embctx.embed_query(query)
         myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
         ress = myredis.ft_search(embedded_query=myquery, vector_field="text_vector", hybrid_fields=myredis.create_hybrid_field(resorg, "category", "res"), k=5)
         if len(ress) == 0:
             return []
 
         resources = []
+        resrows = myredis.hydrate(ress, ['url', 'title'])
         for i, res in enumerate(ress):
-            resurl = myredis.redis.hget(res.id, 'url')
-            resnam = myredis.redis.hget(res.id, 'title')
+            resurl = resrows[i]['url']
+            resnam = resrows[i]['title']
             vscore = 1.0 - float(res.vector_score)
             if resurl is not None:
                 resurl = resurl.decode()
@@ -1321,53 +1407,52 @@ class Session(object):
         return resources
 
     @staticmethod
-    def get_top_resource(query, user_id, org_id, pos=0):
+    def get_resource_candidates(embedded_query, org_id, k=10, offset=0):
         orgnum = get_org_id(org_id)
         resorg = "(0|{})".format(orgnum)
-        myquery = oai_embeddings.embed_query(query)
         myredis = RedisSingleton(password=common_conf_val('redis_password', ''))
-        ress = myredis.ft_search(embedded_query=myquery, vector_field="text_vector", hybrid_fields=myredis.create_hybrid_field(resorg, "category", "res"), k=1, offset=pos)
-        if len(ress) == 0:
-            return None
-        res0 = ress[0]
-        if float(res0.vector_score) > 0.25:
-            return None
-        resurl = myredis.redis.hget(res0.id, 'url')
-        if resurl is None:
-            return None
-        resurl = resurl.decode()
-        resname = myredis.redis.hget(res0.id, 'title')
-        vscore = 1.0 - float(res0.vector_score)
-        if resname is not None:
-            resname = resname.decode()
-        urlnoq = remove_url_query(resurl)
-        restype = 'unknown'
-        if is_image_url(urlnoq):
-            restype = 'image'
-        elif is_video_url(urlnoq):
-            restype = 'video'
-        topres = {'rid':res0.id, 'url':resurl,'name':resname,'type':restype,'score':vscore}
-        return topres
+        ress = myredis.ft_search(embedded_query=embedded_query, vector_field="text_vector", hybrid_fields=myredis.create_hybrid_field(resorg, "category", "res"), k=k, offset=offset)
+        candidates = []
+        resrows = myredis.hydrate(ress, ['url', 'title'])
+        for i, res in enumerate(ress):
+            if float(res.vector_score) > 0.25:
+                break
+            resurl = resrows[i]['url']
+            if resurl is None:
+                break
+            resurl = resurl.decode()
+            resname = resrows[i]['title']
+            vscore = 1.0 - float(res.vector_score)
+            if resname is not None:
+                resname = resname.decode()
+            urlnoq = remove_url_query(resurl)
+            restype = 'unknown'
+            if is_image_url(urlnoq):
+                restype = 'image'
+            elif is_video_url(urlnoq):
+                restype = 'video'
+            candidates.append({'rid':res.id, 'url':resurl,'name':resname,'type':restype,'score':vscore})
+        return candidates
 
     @staticmethod
-    def insert_resource_to_reply(text, user_id, org_id):
+    def insert_resource_to_reply(text, user_id, org_id, embctx=None):
+        if embctx is None:
+            embctx = EmbeddingContext()
         resrids=set()
         paragraphs = text.split("\n\n")
-        for i, paragraph in enumerate(paragraphs):
-            if len(paragraph) < 50:
-                continue
-            found = False
-            for j in range(10):
-                resource = Session.get_top_resource(paragraph, user_id, org_id, j)
-                if resource is None:
-                    found = False
-                    break
-                resrid = resource['rid']
-                if resrid not in resrids:
-                    found = True
-                    resrids.add(resrid)
+        targets = [i for i, paragraph in enumerate(paragraphs) if len(paragraph) >= 50]
+        if len(targets) == 0:
+            return text
+        # one batched embedding request, then one KNN(k=10) per paragraph
+        vectors = embctx.embed_documents([paragraphs[i] for i in targets])
+        for i, vector in zip(targets, vectors):
+            resource = None
+            for candidate in Session.get_resource_candidates(vector, org_id, k=10):
+                if candidate['rid'] not in resrids:
+                    resource = candidate
+                    resrids.add(candidate['rid'])
                     break
-            if not found:
+            if resource is None:
                 continue
             resurl = resource['url']
             resname = resource['name']
@@ -0,0 +1,204 @@
+# encoding:utf-8
+
+import argparse
+import json
+import os
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from config import common_conf_val
+from common import log
+from langchain_core.documents import Document
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+
+DOCSTORE_DB = "docstore.db"
+
+def convert_docstore(store_path):
+    """
+    write docstore + index_to_docstore_id of index.pkl into an on-disk sqlite file
+    """
+    with open(os.path.join(store_path, 'index.pkl'), 'rb') as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    db_path = os.path.join(store_path, DOCSTORE_DB)
+    tmp_path = "{}.{}.tmp".format(db_path, os.getpid())
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute("CREATE TABLE docs (id TEXT PRIMARY KEY, content TEXT, metadata TEXT)")
+        conn.execute("CREATE TABLE idmap (pos INTEGER PRIMARY KEY, docid TEXT)")
+        conn.executemany("INSERT INTO idmap VALUES (?, ?)", ((int(pos), str(docid)) for pos, docid in index_to_docstore_id.items()))
+        conn.executemany("INSERT INTO docs VALUES (?, ?, ?)", (
+            (str(docid), doc.page_content, json.dumps(doc.metadata))
+            for docid, doc in docstore._dict.items()))
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, db_path)
+    log.info("[FAISS] docstore converted: {} ({} docs)", db_path, len(index_to_docstore_id))
+    return db_path
+
+class SqliteDocstore(Docstore, Mapping):
+    """
+    read-only docstore backed by docstore.db, documents are read lazily per hit;
+    doubles as the index_to_docstore_id mapping
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = None
+        self.lock = threading.Lock()
+        with self.lock:
+            self.size = self._conn().execute("SELECT COUNT(*) FROM idmap").fetchone()[0]
+
+    def _conn(self):
+        # reopened on demand, a search may still be running on an evicted store
+        if self.conn is None:
+            self.conn = sqlite3.connect("file:{}?mode=ro".format(self.db_path), uri=True, check_same_thread=False)
+        return self.conn
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def search(self, search):
+        with self.lock:
+            row = self._conn().execute("SELECT content, metadata FROM docs WHERE id = ?", (str(search),)).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(page_content=row[0], metadata=json.loads(row[1]))
+
+    def __getitem__(self, pos):
+        with self.lock:
+            row = self._conn().execute("SELECT docid FROM idmap WHERE pos = ?", (int(pos),)).fetchone()
+        if row is None:
+            raise KeyError(pos)
+        return row[0]
+
+    def __iter__(self):
+        return iter(range(self.size))
+
+    def __len__(self):
+        return self.size
+
+def docstore_ready(store_path):
+    db_path = os.path.join(store_path, DOCSTORE_DB)
+    pkl_path = os.path.join(store_path, 'index.pkl')
+    return os.path.exists(db_path) and os.path.getmtime(db_path) >= os.path.getmtime(pkl_path)
+
+def load_mmap(store_path, embeddings):
+    """
+    FAISS store with a memory-mapped index and a lazily read sqlite docstore,
+    so worker processes share one page-cached copy. docstore.db must be up to date,
+    see docstore_ready
+    """
+    import faiss
+    db_path = os.path.join(store_path, DOCSTORE_DB)
+    index_path = os.path.join(store_path, 'index.faiss')
+    # flat indexes need IO_FLAG_MMAP_IFC (faiss>=1.8), IVF ones accept IO_FLAG_MMAP
+    flags = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+    try:
+        index = faiss.read_index(index_path, flags)
+    except RuntimeError as e:
+        log.warn("[FAISS] mmap not supported for {}, read fully: {}", index_path, e)
+        index = faiss.read_index(index_path)
+    docstore = SqliteDocstore(db_path)
+    return FAISS(embeddings, index, docstore, docstore)
+
+def use_mmap(nbytes):
+    return bool(common_conf_val('faiss_mmap', False)) and nbytes >= int(common_conf_val('faiss_mmap_min_bytes', 64*1024*1024))
+
+class FaissStoreCache(object):
+    """
+    in-process LRU of loaded FAISS stores keyed by store path (/opt/faiss/{faiss_id}),
+    bounded by the on-disk size of the cached stores and reloaded when the index files change
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.stores = OrderedDict()
+            cls._instance.lock = threading.Lock()
+            cls._instance.nbytes = 0
+            cls._instance.counters = {'hits': 0, 'misses': 0, 'reloads': 0, 'evictions': 0}
+        return cls._instance
+
+    @staticmethod
+    def _stat(store_path):
+        mtime = 0.0
+        nbytes = 0
+        for name in ('index.faiss', 'index.pkl'):
+            stat = os.stat(os.path.join(store_path, name))
+            mtime = max(mtime, stat.st_mtime)
+            nbytes += stat.st_size
+        return mtime, nbytes
+
+    def load(self, store_path, embeddings):
+        mtime, nbytes = self._stat(store_path)
+        with self.lock:
+            entry = self.stores.get(store_path)
+            # a store loaded fully while its docstore.db was pending is swapped once it is converted
+            upgrade = entry is not None and not entry['mmap'] and use_mmap(nbytes) and docstore_ready(store_path)
+            if entry is not None and entry['mtime'] == mtime and not upgrade:
+                self.stores.move_to_end(store_path)
+                self.counters['hits'] += 1
+                return entry['store']
+            if entry is not None:
+                self.counters['reloads'] += 1
+            else:
+                self.counters['misses'] += 1
+
+        mmap = use_mmap(nbytes)
+        if mmap and not docstore_ready(store_path):
+            # converting unpickles index.pkl, which is what mmap mode avoids on the request path
+            log.warn("[FAISS] {} missing or stale, loading fully; run python -m model.openai.faiss_store {}", DOCSTORE_DB, store_path)
+            mmap = False
+        if mmap:
+            store = load_mmap(store_path, embeddings)
+            # mapped pages live in the shared page cache, not in this process
+            nbytes = 0
+        else:
+            store = FAISS.load_local(store_path, embeddings)
+
+        max_bytes = int(common_conf_val('faiss_cache_bytes', 512*1024*1024))
+        max_entries = int(common_conf_val('faiss_cache_entries', 256))
+        with self.lock:
+            stale = self.stores.pop(store_path, None)
+            if stale is not None:
+                self.nbytes -= stale['nbytes']
+                self._close(stale)
+            if nbytes <= max_bytes:
+                self.stores[store_path] = {'mtime': mtime, 'nbytes': nbytes, 'mmap': mmap, 'store': store}
+                self.nbytes += nbytes
+            while (self.nbytes > max_bytes or len(self.stores) > max_entries) and len(self.stores) > 0:
+                _, evicted = self.stores.popitem(last=False)
+                self.nbytes -= evicted['nbytes']
+                self._close(evicted)
+                self.counters['evictions'] += 1
+            log.info("[FAISS] store cache: {} stores, {} bytes, {}", len(self.stores), self.nbytes, self.counters)
+        return store
+
+    @staticmethod
+    def _close(entry):
+        if entry['mmap']:
+            entry['store'].docstore.close()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['stores'] = len(self.stores)
+            stats['bytes'] = self.nbytes
+        return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store_path", nargs='+', help="FAISS store directories (e.g: /opt/faiss/<faiss_id>) to convert for mmap mode")
+    args = parser.parse_args()
+    for store_path in args.store_path:
+        convert_docstore(store_path)